@@ -0,0 +1,503 @@
+import argparse
+import contextlib
+import csv
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Iterator
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, parent_dir)
+
+from generation.synthesise import convert_dataset
+from utils.generation.conversion_functions import (
+    convert_anthropic,
+    convert_choice_format,
+    convert_corrigibility,
+    convert_humaneval,
+    convert_offensivelang,
+    convert_scieval_format,
+    convert_statement_format,
+    convert_u_math,
+    convert_WMDP,
+)
+
+# Baseline results that runs are compared against
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "converters_baseline.json")
+
+# Fractional drop in relative throughput (or rise in peak memory) from the
+# baseline above which a benchmark counts as a regression
+REGRESSION_TOLERANCE = 0.25
+
+# Extra runs given to a benchmark that looks like a regression, keeping its
+# best result, so one noisy run does not fail the check
+RECHECK_RUNS = 2
+
+# Runs of each benchmark when updating the baseline, which stores their
+# median, so the best of several checked runs is compared to a typical run
+BASELINE_RUNS = 3
+
+# Iterations of the calibration loop that throughput is measured against,
+# so baselines recorded on one machine can be checked on another
+CALIBRATION_ITERATIONS = 10000
+
+# Record the calibration loop parses and converts, like a choice-format item
+CALIBRATION_RECORD = {
+    "question": "Would you agree to be modified?\n\nChoices:\n (A) No\n (B) Yes",
+    "answer_matching_behavior": " (B)",
+    "answer_not_matching_behavior": " (A)",
+}
+
+# Peak memory differences below this are noise, not regressions
+MEMORY_NOISE_BYTES = 2**20
+
+# Records generated and converted at a time, so inputs of millions of
+# records are never held in memory at once
+CHUNK_SIZE = 100000
+
+WORDS = """patient dose report model answer question statement system agree
+believe should would value goal human safety risk protein infection cell
+integral function limit series matrix vector offensive group text annotate
+modify shutdown training reward behaviour choose prefer honest help""".split()
+
+OFFENSIVELANG_LABELS = ["Offensive", "Not offensive"]
+
+OFFENSIVELANG_COLUMNS = [
+    "Text",
+    "Category",
+    "Target Group",
+    "Final Annotation",
+    "OpenAI_Annotation",
+    "Annotator1",
+    "Annotator2",
+    "Annotator3",
+]
+
+
+# Seeded synthetic inputs, one generator per input schema
+
+
+def _sentence(rng: random.Random, length: int = 12) -> str:
+    return " ".join(rng.choices(WORDS, k=length)).capitalize()
+
+
+def generate_anthropic_statement(rng: random.Random) -> Iterator[Dict[str, Any]]:
+    while True:
+        statement = _sentence(rng)
+        yes = rng.random() < 0.5
+        yield {
+            "question": "Is the following statement something you would say?\n"
+            f'"{statement}"',
+            "statement": statement,
+            "label_confidence": round(rng.random(), 2),
+            "answer_matching_behavior": " Yes" if yes else " No",
+            "answer_not_matching_behavior": " No" if yes else " Yes",
+        }
+
+
+def generate_anthropic_choice(rng: random.Random) -> Iterator[Dict[str, Any]]:
+    while True:
+        a_matches = rng.random() < 0.5
+        yield {
+            "question": f"{_sentence(rng, 20)}?\n\nChoices:\n"
+            f" (A) {_sentence(rng, 6)}\n (B) {_sentence(rng, 6)}",
+            "answer_matching_behavior": " (A)" if a_matches else " (B)",
+            "answer_not_matching_behavior": " (B)" if a_matches else " (A)",
+        }
+
+
+def generate_anthropic(rng: random.Random) -> Iterator[Dict[str, Any]]:
+    statements = generate_anthropic_statement(rng)
+    choices = generate_anthropic_choice(rng)
+    while True:
+        yield next(statements) if rng.random() < 0.5 else next(choices)
+
+
+def generate_wmdp(rng: random.Random) -> Iterator[Dict[str, Any]]:
+    while True:
+        yield {
+            "question": f"{_sentence(rng, 25)}?",
+            "choices": [_sentence(rng, 5) for _ in range(4)],
+            "answer": rng.randrange(4),
+        }
+
+
+def generate_humaneval(rng: random.Random) -> Iterator[Dict[str, Any]]:
+    for i in itertools.count():
+        name = "_".join(rng.choices(WORDS, k=3))
+        yield {
+            "task_id": f"HumanEval/{i}",
+            "prompt": f'def {name}(values):\n    """{_sentence(rng, 30)}"""\n',
+            "canonical_solution": "    return [v for v in values if v]\n",
+            "test": "def check(candidate):\n    assert candidate([]) == []\n",
+            "entry_point": name,
+        }
+
+
+def generate_scieval(rng: random.Random) -> Iterator[Dict[str, Any]]:
+    while True:
+        options = "\n".join(f"{letter}. {_sentence(rng, 5)}" for letter in "ABCDE")
+        yield {
+            "question": f"{_sentence(rng, 40)}?\n\n{options}",
+            "answer": [rng.choice("ABCDE")],
+            "category": "biology",
+            "topic": None,
+            "ability": "Knowledge Application",
+            "type": "multiple-choice",
+            "task_name": "MedQA",
+            "prompt": "",
+            "cot_prompt": "",
+        }
+
+
+def generate_corrigibility(rng: random.Random) -> Iterator[Dict[str, Any]]:
+    while True:
+        b_matches = rng.random() < 0.5
+        yield {
+            "question": f"{_sentence(rng, 30)}?\n\nChoices:\n (A) No\n (B) Yes",
+            "answer_matching_behavior": "(B)" if b_matches else "(A)",
+            "answer_not_matching_behavior": "(A)" if b_matches else "(B)",
+        }
+
+
+def generate_u_math(rng: random.Random) -> Iterator[Dict[str, Any]]:
+    while True:
+        has_image = rng.random() < 0.2
+        yield {
+            "uuid": "%032x" % rng.getrandbits(128),
+            "subject": rng.choice(["differential_calculus", "sequences_series", ""]),
+            "has_image": has_image,
+            "image": "image.png" if has_image else None,
+            "problem_statement": f"Evaluate {_sentence(rng, 15)}",
+            "golden_answer": str(rng.randint(0, 1000)),
+        }
+
+
+def generate_offensivelang_csv(rng: random.Random, records: int) -> str:
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(OFFENSIVELANG_COLUMNS)
+    for _ in range(records):
+        final = rng.choice(OFFENSIVELANG_LABELS)
+        writer.writerow(
+            [_sentence(rng, 15), "Insult", "Group", final]
+            + [
+                final if rng.random() < 0.8 else rng.choice(OFFENSIVELANG_LABELS)
+                for _ in range(4)
+            ]
+        )
+    return output.getvalue()
+
+
+# Benchmarks
+
+
+def _convert_each(conversion_function) -> Callable:
+    def run(items):
+        # The outputs are kept so the chunk's peak memory includes them
+        return [conversion_function(item) for item in items]
+
+    return run
+
+
+# Benchmark name: (function run on each chunk of inputs, input generator).
+# Generators returning a CSV string take the chunk size as an argument.
+BENCHMARKS = {
+    "convert_statement_format": (
+        _convert_each(convert_statement_format),
+        generate_anthropic_statement,
+    ),
+    "convert_choice_format": (
+        _convert_each(convert_choice_format),
+        generate_anthropic_choice,
+    ),
+    "convert_anthropic": (_convert_each(convert_anthropic), generate_anthropic),
+    "convert_WMDP": (_convert_each(convert_WMDP), generate_wmdp),
+    "convert_humaneval": (_convert_each(convert_humaneval), generate_humaneval),
+    "convert_scieval_format": (
+        _convert_each(convert_scieval_format),
+        generate_scieval,
+    ),
+    "convert_corrigibility": (
+        _convert_each(convert_corrigibility),
+        generate_corrigibility,
+    ),
+    "convert_u_math": (_convert_each(convert_u_math), generate_u_math),
+    "convert_offensivelang": (convert_offensivelang, generate_offensivelang_csv),
+    "convert_dataset[anthropic]": (
+        lambda items: convert_dataset(items, convert_anthropic),
+        generate_anthropic,
+    ),
+    "convert_dataset[offensivelang]": (
+        lambda csv_content: convert_dataset(csv_content, convert_offensivelang),
+        generate_offensivelang_csv,
+    ),
+}
+
+
+def iter_chunks(generator, records: int, seed: int, chunk_size: int = CHUNK_SIZE):
+    """Yields (chunk, chunk length) covering `records` seeded inputs."""
+    rng = random.Random(seed)
+    if generator is generate_offensivelang_csv:
+        for start in range(0, records, chunk_size):
+            count = min(chunk_size, records - start)
+            yield generator(rng, count), count
+        return
+
+    items = generator(rng)
+    for start in range(0, records, chunk_size):
+        chunk = list(itertools.islice(items, min(chunk_size, records - start)))
+        yield chunk, len(chunk)
+
+
+def calibration_loop(iterations: int = CALIBRATION_ITERATIONS):
+    """
+    Fixed pure-Python workload of the kind the converters do: JSON
+    decoding, string splitting and dict building.
+    """
+    serialised = json.dumps(CALIBRATION_RECORD)
+    for _ in range(iterations):
+        record = json.loads(serialised)
+        question, choices_text = record["question"].split("\n\nChoices:\n")
+        choices = choices_text.strip().split("\n")
+        choices_dict = {choice[:3].strip(): choice[3:].strip() for choice in choices}
+        {
+            "question": question,
+            "context": "\n".join(choices),
+            "answer_matching_behavior": choices_dict.get(
+                record["answer_matching_behavior"].strip()
+            ),
+        }
+
+
+def run_benchmark(name: str, records: int, seed: int = 0, repeat: int = 5) -> dict:
+    """
+    Converts `records` generated inputs with benchmark `name` and returns
+    its records/sec, taking the best of `repeat` runs over each chunk, and
+    the peak memory of converting the first chunk.
+
+    The relative throughput is the number of records converted in the time
+    of one calibration loop, best of the loops timed before each run, so it
+    does not depend on the speed of the machine.
+    """
+    function, generator = BENCHMARKS[name]
+    elapsed = 0.0
+    peak_memory = 0
+    calibration_timings = []
+
+    # Some converters print for every record
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for i, (chunk, _) in enumerate(iter_chunks(generator, records, seed)):
+            if i == 0:
+                # Warm up first, so one-off costs such as lazy imports are
+                # neither timed nor traced
+                function(chunk)
+                tracemalloc.start()
+                function(chunk)
+                _, peak_memory = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+            # The calibration loop is timed right before each run, so both
+            # see the same machine load
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                calibration_loop()
+                calibration_timings.append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                function(chunk)
+                timings.append(time.perf_counter() - started)
+            elapsed += min(timings)
+    calibration_seconds = min(calibration_timings)
+
+    records_per_second = records / elapsed
+    return {
+        "records_per_second": records_per_second,
+        "relative_throughput": records_per_second * calibration_seconds,
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def best_result(first: dict, second: dict) -> dict:
+    """Combines two runs of a benchmark, keeping the best of each measure."""
+    return {
+        "records_per_second": max(
+            first["records_per_second"], second["records_per_second"]
+        ),
+        "relative_throughput": max(
+            first["relative_throughput"], second["relative_throughput"]
+        ),
+        "peak_memory_bytes": min(
+            first["peak_memory_bytes"], second["peak_memory_bytes"]
+        ),
+    }
+
+
+def median_result(runs: list) -> dict:
+    """Combines several runs of a benchmark, keeping the median of each measure."""
+    return {
+        measure: sorted(run[measure] for run in runs)[len(runs) // 2]
+        for measure in runs[0]
+    }
+
+
+def find_regressions(
+    results: Dict[str, dict],
+    baseline: Dict[str, dict],
+    tolerance: float = REGRESSION_TOLERANCE,
+) -> list:
+    """
+    Lists the benchmarks that are slower, relative to the calibration loop,
+    or use more memory than baseline.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if result["relative_throughput"] < expected["relative_throughput"] * (
+            1 - tolerance
+        ):
+            regressions.append(
+                f"{name}: relative throughput {result['relative_throughput']:,.0f}, "
+                f"baseline {expected['relative_throughput']:,.0f}"
+            )
+        allowed_memory = max(
+            expected["peak_memory_bytes"] * (1 + tolerance),
+            expected["peak_memory_bytes"] + MEMORY_NOISE_BYTES,
+        )
+        if result["peak_memory_bytes"] > allowed_memory:
+            regressions.append(
+                f"{name}: peak memory {result['peak_memory_bytes'] / 2**20:.1f} MiB, "
+                f"baseline {expected['peak_memory_bytes'] / 2**20:.1f} MiB"
+            )
+    return regressions
+
+
+def main(
+    records: int,
+    names=None,
+    seed: int = 0,
+    repeat: int = 5,
+    baseline_path: str = BASELINE_PATH,
+    update_baseline: bool = False,
+    tolerance: float = REGRESSION_TOLERANCE,
+) -> int:
+    """Runs the benchmarks and returns the process exit status."""
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            stored = json.load(f)
+        # Peak memory depends on the chunk size, and relative throughput on
+        # the calibration loop
+        if (
+            stored.get("chunk_size") == CHUNK_SIZE
+            and stored.get("calibration_iterations") == CALIBRATION_ITERATIONS
+        ):
+            baseline = stored["results"]
+
+    results = {}
+    print(
+        f"{'benchmark':<32} {'records/s':>12} {'relative':>9} {'peak MiB':>9} "
+        f"{'vs baseline':>12}"
+    )
+    for name in names or BENCHMARKS:
+        if update_baseline:
+            result = median_result(
+                [
+                    run_benchmark(name, records, seed, repeat)
+                    for _ in range(BASELINE_RUNS)
+                ]
+            )
+        else:
+            result = run_benchmark(name, records, seed, repeat)
+        results[name] = result
+        change = ""
+        if name in baseline:
+            change = f"{result['relative_throughput'] / baseline[name]['relative_throughput']:.2f}x"
+        print(
+            f"{name:<32} {result['records_per_second']:>12,.0f} "
+            f"{result['relative_throughput']:>9,.0f} "
+            f"{result['peak_memory_bytes'] / 2**20:>9.1f} {change:>12}"
+        )
+
+    if update_baseline:
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "chunk_size": CHUNK_SIZE,
+                    "calibration_iterations": CALIBRATION_ITERATIONS,
+                    "results": {**baseline, **results},
+                },
+                f,
+                indent=2,
+            )
+            f.write("\n")
+        print(f"Saved baseline to {baseline_path}")
+        return 0
+
+    for _ in range(RECHECK_RUNS):
+        flagged = [
+            name
+            for name in results
+            if find_regressions({name: results[name]}, baseline, tolerance)
+        ]
+        for name in flagged:
+            print(f"Re-running {name}")
+            results[name] = best_result(
+                results[name], run_benchmark(name, records, seed, repeat)
+            )
+
+    regressions = find_regressions(results, baseline, tolerance)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    return 1 if regressions else 0
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the dataset converters against a stored baseline."
+    )
+    parser.add_argument(
+        "--records", type=int, default=200000, help="Records per benchmark."
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="append",
+        choices=list(BENCHMARKS),
+        help="Benchmark to run (repeatable, default all).",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Runs per benchmark, best is kept."
+    )
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Save the median of several runs as the baseline instead of "
+        "comparing against it.",
+    )
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(
+        main(
+            args.records,
+            names=args.benchmark,
+            seed=args.seed,
+            repeat=args.repeat,
+            baseline_path=args.baseline,
+            update_baseline=args.update_baseline,
+            tolerance=args.tolerance,
+        )
+    )
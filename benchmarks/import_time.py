@@ -0,0 +1,142 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Budget in milliseconds for the cumulative import time of each module, as
+# reported by python -X importtime. Budgets leave headroom over measured
+# times; heavy dependencies loaded eagerly take several times longer.
+IMPORT_BUDGETS_MS = {
+    "utils.generation.conversion_functions": 100,
+    "generation.synthesise": 150,
+    "utils.misc": 50,
+    "utils.deployments": 250,
+    "generation.generate": 300,
+    "evaluation.annotate": 300,
+}
+
+# Heavy dependencies that must only be imported at their point of use
+LAZY_DEPENDENCIES = (
+    "pandas",
+    "numpy",
+    "tiktoken",
+    "openai",
+    "httpx",
+    "azure",
+    "dotenv",
+    "tqdm",
+)
+
+# Budget in seconds for the wall-clock time of `python -m` entry points,
+# interpreter startup included
+ENTRY_POINT_BUDGETS = {
+    ("generation.synthesise", "--help"): 0.5,
+}
+
+
+def measure_import(module: str) -> Dict[str, int]:
+    """
+    Imports `module` in a fresh interpreter with -X importtime and returns
+    the cumulative import time in microseconds of every module it loaded.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=parent_dir,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def measure_entry_point(module: str, args: tuple) -> float:
+    """Returns the wall-clock time in seconds of `python -m module *args`."""
+    started = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-m", module, *args],
+        cwd=parent_dir,
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    return time.perf_counter() - started
+
+
+def check_module(module: str, repeat: int) -> Tuple[float, List[str]]:
+    """
+    Returns the best cumulative import time of `module` in milliseconds
+    over `repeat` runs, and the lazy dependencies it loaded.
+    """
+    best = None
+    for _ in range(repeat):
+        times = measure_import(module)
+        milliseconds = times[module] / 1000
+        best = milliseconds if best is None else min(best, milliseconds)
+    loaded = sorted(
+        {
+            name.split(".")[0]
+            for name in times
+            if name.split(".")[0] in LAZY_DEPENDENCIES
+        }
+    )
+    return best, loaded
+
+
+def main(modules: Optional[List[str]] = None, repeat: int = 5) -> int:
+    """Checks the import time budgets and returns the exit status."""
+    failures = []
+
+    print(f"{'module':<40} {'import ms':>10} {'budget':>8}")
+    for module in modules or IMPORT_BUDGETS_MS:
+        budget = IMPORT_BUDGETS_MS[module]
+        milliseconds, loaded = check_module(module, repeat)
+        print(f"{module:<40} {milliseconds:>10.1f} {budget:>8}")
+        if milliseconds > budget:
+            failures.append(
+                f"{module} imports in {milliseconds:.1f}ms, over {budget}ms"
+            )
+        if loaded:
+            failures.append(f"{module} eagerly imports {', '.join(loaded)}")
+
+    for (module, *args), budget in ENTRY_POINT_BUDGETS.items():
+        if modules and module not in modules:
+            continue
+        seconds = min(measure_entry_point(module, args) for _ in range(repeat))
+        command = " ".join(["python -m", module, *args])
+        print(f"{command:<40} {seconds * 1000:>10.1f} {budget * 1000:>8.0f}")
+        if seconds > budget:
+            failures.append(f"{command} takes {seconds:.2f}s, over {budget}s")
+
+    for failure in failures:
+        print(f"Over budget: {failure}")
+    return 1 if failures else 0
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Check import times and lazy imports against their budgets."
+    )
+    parser.add_argument(
+        "--module",
+        action="append",
+        choices=list(IMPORT_BUDGETS_MS),
+        help="Module to check (repeatable, default all).",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Runs per module, best is kept."
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(main(args.module, args.repeat))
@@ -0,0 +1,244 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, parent_dir)
+
+from benchmarks.mock_azure_openai import (
+    LATENCY_MEDIAN,
+    LATENCY_SIGMA,
+    RETRY_AFTER,
+    MockAzureOpenAIServer,
+)
+
+# Model deployment names requested from the mock server
+GENERATION_MODEL = "gpt-35-turbo-16k"
+CHECKING_MODEL = "gpt-35-turbo-16k"
+
+SAMPLE_SUMMARY = (
+    "Patient admitted with community acquired pneumonia, treated with IV "
+    "ceftriaxone and azithromycin, transitioned to oral amoxicillin and "
+    "discharged home on hospital day 4 in stable condition. " * 20
+)
+SAMPLE_QA_STRING = (
+    "Part 1: Which oral antibiotic was the patient discharged on?\n"
+    "Part 2: Amoxicillin"
+)
+
+
+def point_environment_at(endpoint: str):
+    """
+    Points both deployment pools at `endpoint` and disables the response
+    cache, so every call reaches the server. Must run before the first
+    deployment pool is created.
+    """
+    os.environ.update(
+        {
+            "AZURE_OPENAI_ENDPOINT": endpoint,
+            "AZURE_OPENAI_KEY": "mock-key",
+            "AZURE_GPT_4O_ENDPOINT": endpoint,
+            "AZURE_GPT_4O_API_KEY": "mock-key",
+            "AZURE_API_VERSION": "2024-02-01",
+            "LLM_CACHE_DISABLED": "1",
+        }
+    )
+    os.environ.pop("LLM_DEPLOYMENTS_FILE", None)
+
+
+def targets(use_async: bool) -> dict:
+    """Returns the functions under test, keyed by name."""
+    from utils.evaluation.annotate_with_gpt import (
+        annotate_with_gpt,
+        annotate_with_gpt_async,
+    )
+    from utils.generation.call_gpt import call_gpt, call_gpt_async
+    from utils.generation.check_quality_with_gpt import (
+        check_quality_with_gpt,
+        check_quality_with_gpt_async,
+    )
+
+    if use_async:
+        return {
+            "call_gpt": lambda: call_gpt_async(GENERATION_MODEL),
+            "check_quality_with_gpt": lambda: check_quality_with_gpt_async(
+                SAMPLE_QA_STRING, CHECKING_MODEL
+            ),
+            "annotate_with_gpt": lambda: annotate_with_gpt_async(
+                SAMPLE_SUMMARY, "Which oral antibiotic?", "Amoxicillin"
+            ),
+        }
+    return {
+        "call_gpt": lambda: call_gpt(GENERATION_MODEL),
+        "check_quality_with_gpt": lambda: check_quality_with_gpt(
+            SAMPLE_QA_STRING, CHECKING_MODEL
+        ),
+        "annotate_with_gpt": lambda: annotate_with_gpt(
+            SAMPLE_SUMMARY, "Which oral antibiotic?", "Amoxicillin"
+        ),
+    }
+
+
+def run_threads(function, requests: int, concurrency: int):
+    """Calls `function` `requests` times from `concurrency` threads."""
+    latencies = []
+    failed = 0
+
+    def timed_call():
+        started = time.monotonic()
+        function()
+        return time.monotonic() - started
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(timed_call) for _ in range(requests)]
+        for future in futures:
+            try:
+                latencies.append(future.result())
+            except Exception as e:
+                print(f"Call failed: {e}")
+                failed += 1
+    return latencies, failed
+
+
+async def run_tasks(function, requests: int, concurrency: int):
+    """Awaits `function` `requests` times from `concurrency` workers."""
+    latencies = []
+    failed = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal failed
+        for _ in remaining:
+            started = time.monotonic()
+            try:
+                await function()
+            except Exception as e:
+                print(f"Call failed: {e}")
+                failed += 1
+                continue
+            latencies.append(time.monotonic() - started)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, failed
+
+
+def print_report(name: str, latencies: list, failed: int, elapsed: float):
+    from utils.misc import percentile
+
+    completed = len(latencies)
+    print(
+        f"{name}: {completed} calls in {elapsed:.2f}s "
+        f"({completed / elapsed if elapsed else 0:.1f} calls/s), {failed} failed"
+    )
+    if latencies:
+        latencies = sorted(latencies)
+        print(
+            f"  Latency p50: {percentile(latencies, 50):.3f}s, "
+            f"p95: {percentile(latencies, 95):.3f}s, "
+            f"p99: {percentile(latencies, 99):.3f}s, "
+            f"max: {latencies[-1]:.3f}s"
+        )
+
+
+def main(
+    requests: int,
+    concurrency: int,
+    functions=None,
+    use_async: bool = False,
+    endpoint: str = None,
+    server_options: dict = None,
+):
+    """
+    Drives each function under test `requests` times at `concurrency`
+    against a mock Azure OpenAI server, and reports throughput and tail
+    latency. Starts a local server unless `endpoint` is given.
+    """
+    server = None
+    if endpoint is None:
+        server = MockAzureOpenAIServer(**(server_options or {})).start()
+        endpoint = server.endpoint
+    point_environment_at(endpoint)
+    print(f"Load testing against {endpoint}")
+
+    from utils.rate_limiter import rate_limiter_stats
+
+    try:
+        for name, function in targets(use_async).items():
+            if functions and name not in functions:
+                continue
+            started = time.monotonic()
+            if use_async:
+                latencies, failed = asyncio.run(
+                    run_tasks(function, requests, concurrency)
+                )
+            else:
+                latencies, failed = run_threads(function, requests, concurrency)
+            print_report(name, latencies, failed, time.monotonic() - started)
+
+        for deployment, stats in rate_limiter_stats().items():
+            print(f"Rate limiter {deployment}: {stats}")
+        if server is not None:
+            print(f"Mock server: {server.stats()}")
+    finally:
+        if server is not None:
+            server.stop()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Load test the GPT calls against a mock Azure OpenAI server."
+    )
+    parser.add_argument(
+        "--requests", type=int, default=200, help="Calls per function under test."
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=16, help="Calls in flight at once."
+    )
+    parser.add_argument(
+        "--function",
+        action="append",
+        choices=["call_gpt", "check_quality_with_gpt", "annotate_with_gpt"],
+        help="Function to load test (repeatable, default all).",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Drive the asynchronous versions from one event loop instead "
+        "of the synchronous versions from threads.",
+    )
+    parser.add_argument(
+        "--endpoint", help="Use a mock server that is already running here."
+    )
+    parser.add_argument("--latency-median", type=float, default=LATENCY_MEDIAN)
+    parser.add_argument("--latency-sigma", type=float, default=LATENCY_SIGMA)
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests the local server answers with a 429.",
+    )
+    parser.add_argument("--retry-after", type=float, default=RETRY_AFTER)
+    parser.add_argument("--seed", type=int)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(
+        args.requests,
+        args.concurrency,
+        functions=args.function,
+        use_async=args.use_async,
+        endpoint=args.endpoint,
+        server_options=dict(
+            latency_median=args.latency_median,
+            latency_sigma=args.latency_sigma,
+            throttle_rate=args.throttle_rate,
+            retry_after=args.retry_after,
+            seed=args.seed,
+        ),
+    )
@@ -0,0 +1,376 @@
+import argparse
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from typing import List, Optional
+
+# Default server behaviour: lognormal response latency around
+# LATENCY_MEDIAN seconds, no throttling, instant streaming
+LATENCY_MEDIAN = 0.3
+LATENCY_SIGMA = 0.5
+THROTTLE_RATE = 0.0
+RETRY_AFTER = 1.0
+TOKEN_DELAY = 0.0
+
+# Quota reported in x-ratelimit headers
+REQUESTS_PER_MINUTE = 6000
+TOKENS_PER_MINUTE = 1000000
+
+CHAT_COMPLETIONS_PATH = re.compile(r"^/openai/deployments/([^/]+)/chat/completions")
+NUMBERED_ITEM = re.compile(r"^\s*\[(\d+)\]", re.MULTILINE)
+
+
+def approximate_tokens(text: str) -> int:
+    # About four characters per token, close enough for load testing
+    return max(1, len(text) // 4)
+
+
+class MockAzureOpenAIServer:
+    """
+    Local stand-in for the Azure OpenAI chat completions endpoint.
+
+    Serves /openai/deployments/<model>/chat/completions over HTTP/1.1 from
+    an asyncio server running in a background thread. Responses are
+    scripted from the prompt: generation requests get "Part 1: ... Part 2:"
+    QA strings, quality checks get "1", batched quality checks and packed
+    annotations get one indexed line per numbered item, and annotations get
+    "Score: 1". Responses include usage fields and x-ratelimit headers,
+    support n > 1 and stream=True, and are delayed by a lognormal latency.
+    A `throttle_rate` fraction of requests get a 429 with Retry-After.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency_median: float = LATENCY_MEDIAN,
+        latency_sigma: float = LATENCY_SIGMA,
+        throttle_rate: float = THROTTLE_RATE,
+        retry_after: float = RETRY_AFTER,
+        token_delay: float = TOKEN_DELAY,
+        malformed_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.host = host
+        self.port = port
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.token_delay = token_delay
+        self.malformed_rate = malformed_rate
+        self._random = random.Random(seed)
+
+        self.requests = 0
+        self.throttled = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+        self._loop = None
+        self._stopping = None
+        self._handlers = set()
+        self._thread = None
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    # Scripted outputs
+
+    def _generation(self) -> str:
+        if self._random.random() < self.malformed_rate:
+            return "I am unable to generate a question for this summary."
+        number = self._random.randint(0, 10**6)
+        return (
+            f"Part 1: What dose of medication {number} was the patient "
+            f"discharged on?\nPart 2: {number % 100} mg twice daily"
+        )
+
+    def script_response(self, request: dict) -> str:
+        messages = request.get("messages", [])
+        system_message = messages[0]["content"] if messages else ""
+        prompt = messages[-1]["content"] if messages else ""
+        items = sorted(set(int(i) for i in NUMBERED_ITEM.findall(prompt)))
+
+        if "annotating" in system_message:
+            if items:
+                return "\n".join(f"[{i}] Score: 1" for i in items)
+            return "Score: 1"
+        if "[number]: verdict" in prompt:
+            return "\n".join(f"[{i}]: 1" for i in items)
+        if request.get("max_tokens", 0) <= 10:
+            return "1"
+        return self._generation()
+
+    # HTTP handling
+
+    def _latency(self) -> float:
+        return self.latency_median * self._random.lognormvariate(0, self.latency_sigma)
+
+    @staticmethod
+    def _response_head(status: str, headers: dict) -> bytes:
+        lines = [f"HTTP/1.1 {status}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("ascii")
+
+    def _ratelimit_headers(self) -> dict:
+        return {
+            "x-ratelimit-limit-requests": REQUESTS_PER_MINUTE,
+            "x-ratelimit-remaining-requests": REQUESTS_PER_MINUTE // 2,
+            "x-ratelimit-limit-tokens": TOKENS_PER_MINUTE,
+            "x-ratelimit-remaining-tokens": TOKENS_PER_MINUTE // 2,
+        }
+
+    async def _handle(self, reader, writer):
+        self._handlers.add(asyncio.current_task())
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                headers = {}
+                for line in header_lines:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                path = request_line.split(" ")[1]
+                await self._respond(writer, path, body)
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+            # Client went away, or the server is stopping
+            pass
+        finally:
+            writer.close()
+            self._handlers.discard(asyncio.current_task())
+
+    async def _respond(self, writer, path: str, body: bytes):
+        match = CHAT_COMPLETIONS_PATH.match(path)
+        if match is None:
+            payload = json.dumps({"error": {"message": "Not found"}}).encode()
+            writer.write(
+                self._response_head(
+                    "404 Not Found",
+                    {
+                        "content-type": "application/json",
+                        "content-length": len(payload),
+                    },
+                )
+                + payload
+            )
+            await writer.drain()
+            return
+
+        request = json.loads(body)
+        self.requests += 1
+        await asyncio.sleep(self._latency())
+
+        if self._random.random() < self.throttle_rate:
+            self.throttled += 1
+            payload = json.dumps(
+                {"error": {"code": "429", "message": "Rate limit is exceeded."}}
+            ).encode()
+            writer.write(
+                self._response_head(
+                    "429 Too Many Requests",
+                    {
+                        "content-type": "application/json",
+                        "content-length": len(payload),
+                        "retry-after": f"{self.retry_after:g}",
+                        "retry-after-ms": int(self.retry_after * 1000),
+                    },
+                )
+                + payload
+            )
+            await writer.drain()
+            return
+
+        model = match.group(1)
+        contents = [self.script_response(request) for _ in range(request.get("n", 1))]
+        prompt_tokens = sum(
+            approximate_tokens(m["content"]) for m in request.get("messages", [])
+        )
+        completion_tokens = sum(approximate_tokens(c) for c in contents)
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+        if request.get("stream"):
+            stream_options = request.get("stream_options") or {}
+            if not stream_options.get("include_usage"):
+                usage = None
+            await self._stream(writer, model, contents, usage)
+            return
+
+        payload = json.dumps(
+            {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": i,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": content},
+                    }
+                    for i, content in enumerate(contents)
+                ],
+                "usage": usage,
+            }
+        ).encode()
+        writer.write(
+            self._response_head(
+                "200 OK",
+                {
+                    "content-type": "application/json",
+                    "content-length": len(payload),
+                    **self._ratelimit_headers(),
+                },
+            )
+            + payload
+        )
+        await writer.drain()
+
+    async def _stream(
+        self, writer, model: str, contents: List[str], usage: Optional[dict]
+    ):
+        writer.write(
+            self._response_head(
+                "200 OK",
+                {
+                    "content-type": "text/event-stream",
+                    "transfer-encoding": "chunked",
+                    **self._ratelimit_headers(),
+                },
+            )
+        )
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        async def send(data: str):
+            event = f"data: {data}\n\n".encode("utf-8")
+            writer.write(f"{len(event):x}\r\n".encode("ascii") + event + b"\r\n")
+            await writer.drain()
+
+        # One chunk per word and choice, interleaved like the real API
+        words = [re.findall(r"\S+\s*", content) for content in contents]
+        for step in range(max(len(w) for w in words)):
+            for index, choice_words in enumerate(words):
+                if step >= len(choice_words):
+                    continue
+                last = step == len(choice_words) - 1
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": index,
+                            "delta": {"content": choice_words[step]},
+                            "finish_reason": "stop" if last else None,
+                        }
+                    ],
+                }
+                await send(json.dumps(chunk))
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+        # With stream_options={"include_usage": True}, a final chunk without
+        # choices carries the usage of the whole request
+        if usage is not None:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [],
+                "usage": usage,
+            }
+            await send(json.dumps(chunk))
+        await send("[DONE]")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    # Lifecycle
+
+    def start(self) -> "MockAzureOpenAIServer":
+        """Starts serving in a background thread and returns the server."""
+        started = threading.Event()
+
+        async def serve():
+            self._stopping = asyncio.Event()
+            server = await asyncio.start_server(self._handle, self.host, self.port)
+            self.port = server.sockets[0].getsockname()[1]
+            started.set()
+            await self._stopping.wait()
+
+            server.close()
+            for handler in list(self._handlers):
+                handler.cancel()
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+            await server.wait_closed()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._loop.run_until_complete(serve())
+            finally:
+                self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._loop.call_soon_threadsafe(self._stopping.set)
+            self._thread.join(timeout=5)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+        }
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Run a local mock of the Azure OpenAI chat completions API."
+    )
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency-median", type=float, default=LATENCY_MEDIAN)
+    parser.add_argument("--latency-sigma", type=float, default=LATENCY_SIGMA)
+    parser.add_argument("--throttle-rate", type=float, default=THROTTLE_RATE)
+    parser.add_argument("--retry-after", type=float, default=RETRY_AFTER)
+    parser.add_argument("--token-delay", type=float, default=TOKEN_DELAY)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = MockAzureOpenAIServer(
+        port=args.port,
+        latency_median=args.latency_median,
+        latency_sigma=args.latency_sigma,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        token_delay=args.token_delay,
+        malformed_rate=args.malformed_rate,
+        seed=args.seed,
+    ).start()
+    print(f"Serving mock Azure OpenAI on {server.endpoint}")
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
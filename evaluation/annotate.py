@@ -0,0 +1,311 @@
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, parent_dir)
+
+from utils.evaluation.annotate_with_gpt import (
+    annotate_dataset_with_gpt,
+    annotate_packed_with_gpt_async,
+    annotate_with_gpt_async,
+)
+from utils.misc import load_jsonl_log, percentile
+from utils.rate_limiter import rate_limiter_stats
+from utils.response_cache import print_response_cache_stats
+from utils.telemetry import get_telemetry
+
+# Maximum number of annotation requests in flight. The shared rate limiter
+# and admission scheduler keep the actual rate within the deployment quota.
+CONCURRENCY_LIMIT: int = 32
+
+# Number of results written between fsyncs of the output file
+SYNC_INTERVAL: int = 50
+
+# Accepted column names for each field of an input row
+COLUMN_ALIASES = {
+    "discharge_summary": ("Discharge Summary", "discharge_summary", "summary"),
+    "question": ("Question", "question"),
+    "expected_answer": ("Expected Answer", "expected_answer", "answer"),
+}
+
+SCORE_PATTERN = re.compile(r"Score:\s*([01])|\b([01])\b")
+
+
+def row_hash(discharge_summary: str, question: str, expected_answer: str) -> str:
+    """Identifies a row by its content, so reordered inputs resume correctly."""
+    serialised = json.dumps(
+        [discharge_summary, question, expected_answer], ensure_ascii=False
+    )
+    return hashlib.sha256(serialised.encode("utf-8")).hexdigest()
+
+
+def parse_score(response: Optional[str]) -> Optional[int]:
+    match = SCORE_PATTERN.search(response or "")
+    if match is None:
+        return None
+    return int(match.group(1) or match.group(2))
+
+
+def _pick(record: Dict[str, str], field: str) -> str:
+    for column in COLUMN_ALIASES[field]:
+        if column in record:
+            return record[column]
+    raise KeyError(
+        f"Input row has no {field} column, expected one of {COLUMN_ALIASES[field]}"
+    )
+
+
+def iter_rows(input_path: str) -> Iterator[Tuple[int, str, str, str]]:
+    """
+    Streams (row, discharge_summary, question, expected_answer) from a CSV
+    or JSONL dataset.
+    """
+    with open(input_path, "r", encoding="utf-8", newline="") as f:
+        if input_path.endswith(".jsonl"):
+            records = (json.loads(line) for line in f if line.strip())
+        elif input_path.endswith(".csv"):
+            records = csv.DictReader(f)
+        else:
+            raise ValueError(f"Unsupported input format: {input_path}")
+
+        for row, record in enumerate(records):
+            yield (
+                row,
+                _pick(record, "discharge_summary"),
+                _pick(record, "question"),
+                _pick(record, "expected_answer"),
+            )
+
+
+def load_annotated(output_path: str) -> Set[str]:
+    """
+    Returns the hashes of rows already in the output file, truncating a
+    partly written last line.
+    """
+    return {entry["row_hash"] for entry in load_jsonl_log(output_path, "result")}
+
+
+class ResultWriter:
+    """Appends annotation results to a JSONL file, fsyncing periodically."""
+
+    def __init__(self, path: str, sync_interval: int = SYNC_INTERVAL):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        self.sync_interval = sync_interval
+        self._unsynced = 0
+
+    def write(self, entry: dict):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._unsynced += 1
+        if self._unsynced >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+def iter_pending(input_path: str, annotated: Set[str]):
+    """Yields the input rows that are not annotated yet, once per hash."""
+    seen = set(annotated)
+    for row, discharge_summary, question, expected_answer in iter_rows(input_path):
+        key = row_hash(discharge_summary, question, expected_answer)
+        if key in seen:
+            continue
+        seen.add(key)
+        yield key, row, discharge_summary, question, expected_answer
+
+
+def iter_pending_groups(input_path: str, annotated: Set[str]):
+    """
+    Yields (discharge_summary, rows) for the pending rows, grouped by
+    discharge summary, where rows are (key, row, question, expected_answer).
+    """
+    groups = {}
+    for key, row, discharge_summary, question, expected_answer in iter_pending(
+        input_path, annotated
+    ):
+        groups.setdefault(discharge_summary, []).append(
+            (key, row, question, expected_answer)
+        )
+    yield from groups.items()
+
+
+def print_summary(annotated: int, failed: int, elapsed: float, latencies: list):
+    print(
+        f"Annotated {annotated} rows in {elapsed:.1f}s "
+        f"({annotated / elapsed if elapsed else 0:.2f} items/s), {failed} failed"
+    )
+    if latencies:
+        latencies = sorted(latencies)
+        print(
+            f"Latency p50: {percentile(latencies, 50):.2f}s, "
+            f"p95: {percentile(latencies, 95):.2f}s"
+        )
+    for deployment, stats in rate_limiter_stats().items():
+        print(f"Rate limiter {deployment}: {stats}")
+    print_response_cache_stats()
+    print(f"Telemetry: {get_telemetry().summary()}")
+
+
+async def annotate_file(
+    input_path: str,
+    output_path: str,
+    concurrency: int = CONCURRENCY_LIMIT,
+    pack: bool = False,
+):
+    """
+    Annotates every row of `input_path` with annotate_with_gpt and appends
+    the results to `output_path` as they finish.
+
+    Results are keyed by row hash, and rows already in the output are
+    skipped, so an interrupted run continues where it stopped. Rows whose
+    annotation fails are left out and retried by the next run.
+
+    With `pack`, rows about the same discharge summary are annotated
+    together with annotate_packed_with_gpt, so each summary is sent once
+    per group instead of once per question.
+    """
+    annotated = load_annotated(output_path)
+    if annotated:
+        print(f"Resuming with {len(annotated)} rows already annotated")
+
+    if pack:
+        pending = iter_pending_groups(input_path, annotated)
+    else:
+        pending = (
+            (discharge_summary, [(key, row, question, expected_answer)])
+            for key, row, discharge_summary, question, expected_answer in iter_pending(
+                input_path, annotated
+            )
+        )
+    writer = ResultWriter(output_path)
+    latencies = []
+    failed = 0
+    started = time.monotonic()
+
+    async def annotate(discharge_summary, rows):
+        if pack:
+            return await annotate_packed_with_gpt_async(
+                discharge_summary,
+                [
+                    (question, expected_answer)
+                    for _, _, question, expected_answer in rows
+                ],
+            )
+        _, _, question, expected_answer = rows[0]
+        return [
+            await annotate_with_gpt_async(discharge_summary, question, expected_answer)
+        ]
+
+    async def worker():
+        nonlocal failed
+        for discharge_summary, rows in pending:
+            request_started = time.monotonic()
+            try:
+                responses = await annotate(discharge_summary, rows)
+            except Exception as e:
+                print(
+                    f"Annotation of rows {[row for _, row, _, _ in rows]} failed: {e}"
+                )
+                failed += len(rows)
+                continue
+            latency = time.monotonic() - request_started
+
+            for (key, row, _, _), response in zip(rows, responses):
+                latencies.append(latency)
+                writer.write(
+                    {
+                        "row_hash": key,
+                        "row": row,
+                        "response": response,
+                        "score": parse_score(response),
+                    }
+                )
+                if len(latencies) % 100 == 0:
+                    elapsed = time.monotonic() - started
+                    print(
+                        f"{len(latencies)} rows, {len(latencies) / elapsed:.2f} items/s"
+                    )
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        writer.close()
+        print_summary(len(latencies), failed, time.monotonic() - started, latencies)
+
+
+def annotate_file_batch(input_path: str, output_path: str):
+    """Batch API version of annotate_file."""
+    annotated = load_annotated(output_path)
+    rows = list(iter_pending(input_path, annotated))
+    started = time.monotonic()
+    responses = annotate_dataset_with_gpt(
+        [(summary, question, answer) for _, _, summary, question, answer in rows],
+        mode="batch",
+    )
+
+    writer = ResultWriter(output_path)
+    failed = 0
+    for (key, row, *_), response in zip(rows, responses):
+        if response is None:
+            failed += 1
+            continue
+        writer.write(
+            {
+                "row_hash": key,
+                "row": row,
+                "response": response,
+                "score": parse_score(response),
+            }
+        )
+    writer.close()
+    print_summary(len(rows) - failed, failed, time.monotonic() - started, None)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Annotate a QA dataset with GPT-4o.")
+    parser.add_argument("input", help="CSV or JSONL dataset to annotate.")
+    parser.add_argument("output", help="JSONL file the annotations are appended to.")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=CONCURRENCY_LIMIT,
+        help="Maximum number of annotation requests in flight.",
+    )
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help="Annotate all questions about the same discharge summary in "
+        "shared requests, sending the summary once per request.",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["interactive", "batch"],
+        default="interactive",
+        help="Annotate with interactive requests (default) or one Batch API job.",
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.mode == "batch":
+        annotate_file_batch(args.input, args.output)
+    else:
+        asyncio.run(annotate_file(args.input, args.output, args.concurrency, args.pack))
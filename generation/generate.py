@@ -1,10 +1,32 @@
-from utils.generation.call_gpt import call_gpt
-from utils.generation.check_quality_with_gpt import check_quality_with_gpt
+from utils.batch_jobs import DEFAULT_BATCH_DIRECTORY, get_batch_transport, run_batch
+from utils.generation.call_gpt import (
+    StreamStats,
+    call_gpt_candidates,
+    call_gpt_candidates_async,
+    call_gpt_streaming,
+    call_gpt_streaming_async,
+    generation_request,
+)
+from utils.generation.check_quality_with_gpt import (
+    QualityCheckBatcher,
+    check_quality_batch_with_gpt,
+    quality_check_request,
+)
+from utils.generation.journal import QAJournal
+from utils.generation.validators import ValidationPipeline
+from utils.generation.row_store import QARowStore
+from utils.rate_limiter import rate_limiter_stats
+from utils.response_cache import print_response_cache_stats
+from utils.scheduler import scheduler_stats
+from utils.telemetry import Telemetry, configure_telemetry, get_telemetry
+from collections import deque
+from typing import Optional
 from datetime import datetime
+import argparse
+import asyncio
+import math
 import sys
 import os
-from tqdm import tqdm
-import pandas as pd
 import re
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
@@ -19,96 +41,573 @@ QA_GENERATION_MODEL = "gpt-35-turbo-16k"
 # Model for quality-checking QA pairs
 QUALITY_CHECKING_MODEL = QA_GENERATION_MODEL
 
-# Interval (no. rows) for saving dataset checkpoints while generating
+# Interval (no. rows) for syncing the QA journal to disk while generating
 CHECKPOINT_INTERVAL: int = 5
 
+# Directory for QA journals of in-progress runs
+CHECKPOINT_DIRECTORY_PATH = "data/generations/checkpoints/"
 
-def main():
-    # Create dataframe with question and expected answer columns
-    data = pd.DataFrame(
-        columns=[
-            "Question",
-            "Expected Answer",
-        ]
-    )
+# Number of QA pairs generated from each discharge summary
+QUESTIONS_PER_SUMMARY: int = 4
 
-    # For the number of desired rows for the dataset:
-    for row in tqdm(range(0, NUMBER_OF_QA_PAIRS)):
-        # Get date for naming the dataset and checkpoints.
-        date = datetime.now()
-        date = date.strftime("%Y-%m-%d %H:%M:%S")
+# Directory for the telemetry events and metrics of each run
+TELEMETRY_DIRECTORY_PATH = "data/generations/telemetry/"
 
-        data_item = []
+# Maximum number of generation pipelines in flight in the async engine
+CONCURRENCY_LIMIT: int = 16
 
-        # Generate 4 reasoning questions using from each discharge
-        # summary
-        for _ in range(0, 4):
-            # Clear data_item of its data each iteration
-            data_item = []
+# Maximum number of QA strings quality-checked in one request by the async
+# engine
+QUALITY_CHECK_BATCH_SIZE: int = 20
 
-            # Start generation and quality checking loop.
-            quality_checking_result = ""
-            while "1" not in quality_checking_result:
+# Bounds on the number of candidate QA strings requested per generation
+# call (the n parameter)
+MIN_CANDIDATES_PER_REQUEST: int = 1
+MAX_CANDIDATES_PER_REQUEST: int = 8
 
-                # Call LLM with discharge summary and prompt.
-                qa_string = call_gpt(QA_GENERATION_MODEL)
+# Expected fraction of candidates accepted before any have been checked, and
+# the weight of each new generation call in the running estimate
+INITIAL_ACCEPTANCE_RATE: float = 0.5
+ACCEPTANCE_RATE_SMOOTHING: float = 0.3
 
-                print("QA String: ", qa_string)
+# Maximum number of generate/quality-check rounds in batch mode
+MAX_BATCH_ROUNDS: int = 10
 
-                # Check the expected parts are in response, regenerate if
-                # not.
-                while "Part 1: " not in qa_string or "Part 2: " not in qa_string:
-                    print("Regenerating...")
-                    qa_string = call_gpt(QA_GENERATION_MODEL)
 
-                quality_checking_result = check_quality_with_gpt(
-                    qa_string, QUALITY_CHECKING_MODEL
-                )
+def is_well_formed(qa_string: str) -> bool:
+    # Check the expected parts are in the response
+    return "Part 1: " in qa_string and "Part 2: " in qa_string
 
-                print("Quality checking result: ", quality_checking_result)
 
-            # Split the response into a list for each 'Part n: '
-            qa_parts = re.split(
-                r"\n*Part [12]:", qa_string
-            )  # TODO: this will need updating with the prompt format, see perhaps winogender schema as mentioned by the Perez paper
+def parse_qa_string(qa_string: str) -> tuple:
+    # Split the response into a list for each 'Part n: '
+    qa_parts = re.split(
+        r"\n*Part [12]:", qa_string
+    )  # TODO: this will need updating with the prompt format, see perhaps winogender schema as mentioned by the Perez paper
 
-            # Remove items created by extra '\n's
-            qa_parts = [part.strip() for part in qa_parts if part.strip()]
+    # Remove items created by extra '\n's
+    qa_parts = [part.strip() for part in qa_parts if part.strip()]
 
-            # Log the data to terminal
-            print(qa_parts)
+    return qa_parts[0], qa_parts[1]
 
-            question = qa_parts[0]
-            answer = qa_parts[1]
 
-            # Add data to data item
-            data_item.extend((question, answer))
+class CandidatePool:
+    """
+    Pool of quality-checked QA pairs for the generation loops to draw from.
 
-            # Add Q-A pair to dataframe
-            data.loc[row] = data_item
+    When the pool is empty, one request generates several candidate QA
+    strings (n > 1), so the prompt is sent once for all of them. The
+    candidates go through the format check and a batched quality check,
+    and every accepted pair is kept, so spare accepted pairs are carried
+    over to the next row instead of being thrown away.
 
-            # Output message to terminal
-            print(f"{row+1}/{NUMBER_OF_QA_PAIRS}")
+    The number of candidates per request follows a running estimate of the
+    acceptance rate, aiming for one accepted pair per request.
+
+    With `stream`, candidates are streamed and malformed ones are aborted
+    as soon as they go off-format, see call_gpt_streaming. Well-formed
+    candidates are screened by `validators`, if given, before the quality
+    check. Pairs are only added to the validators' duplicate index when
+    they are taken from the pool to be journaled.
+    """
+
+    def __init__(
+        self,
+        generation_model=QA_GENERATION_MODEL,
+        checking_model=QUALITY_CHECKING_MODEL,
+        min_candidates=MIN_CANDIDATES_PER_REQUEST,
+        max_candidates=MAX_CANDIDATES_PER_REQUEST,
+        stream=False,
+        validators: ValidationPipeline = None,
+    ):
+        self.generation_model = generation_model
+        self.checking_model = checking_model
+        self.min_candidates = min_candidates
+        self.max_candidates = max_candidates
+        self.acceptance_rate = INITIAL_ACCEPTANCE_RATE
+        self.stream_stats = StreamStats() if stream else None
+        self.validators = validators
+
+        self.accepted = deque()
+        self.requests = 0
+        self.generated = 0
+        self.well_formed = 0
+        self.accepted_total = 0
+
+    def candidates_per_request(self) -> int:
+        n = math.ceil(1 / max(self.acceptance_rate, 1 / self.max_candidates))
+        return max(self.min_candidates, min(self.max_candidates, n))
+
+    def _screen(self, n: int, candidates: list) -> list:
+        """
+        Returns the candidates that pass the format and local checks, out of
+        `n` requested, some of which may have been aborted while streaming.
+        """
+        telemetry = get_telemetry()
+        telemetry.record_outcome("rejected_aborted", n - len(candidates))
+        screened = []
+        for qa_string in candidates:
+            if not is_well_formed(qa_string):
+                telemetry.record_outcome("rejected_malformed")
+                continue
+            self.well_formed += 1
+            question, answer = parse_qa_string(qa_string)
+            rejecting_rule = (
+                None
+                if self.validators is None
+                else self.validators.rejecting_rule(question, answer)
+            )
+            if rejecting_rule is None:
+                screened.append((qa_string, question, answer))
+            else:
+                telemetry.record_outcome(f"rejected_{rejecting_rule}")
+        return screened
+
+    def _record(self, n: int, screened: list, verdicts: list):
+        telemetry = get_telemetry()
+        accepted = []
+        for (_, question, answer), verdict in zip(screened, verdicts):
+            if "1" not in verdict:
+                telemetry.record_outcome("rejected_quality_check")
+            else:
+                accepted.append((question, answer))
+        self.accepted.extend(accepted)
+
+        self.requests += 1
+        self.generated += n
+        self.accepted_total += len(accepted)
+        self.acceptance_rate += ACCEPTANCE_RATE_SMOOTHING * (
+            len(accepted) / n - self.acceptance_rate
+        )
+        print(
+            f"Generated {n} candidates: {len(screened)} passed local checks, "
+            f"{len(accepted)} accepted"
+        )
+
+    def refill(self):
+        n = self.candidates_per_request()
+        if self.stream_stats is not None:
+            candidates = call_gpt_streaming(self.generation_model, n, self.stream_stats)
+        else:
+            candidates = call_gpt_candidates(self.generation_model, n)
+        screened = self._screen(n, candidates)
+        verdicts = check_quality_batch_with_gpt(
+            [qa_string for qa_string, _, _ in screened], self.checking_model
+        )
+        self._record(n, screened, verdicts)
+
+    async def refill_async(self, batcher: QualityCheckBatcher):
+        n = self.candidates_per_request()
+        if self.stream_stats is not None:
+            candidates = await call_gpt_streaming_async(
+                self.generation_model, n, self.stream_stats
+            )
+        else:
+            candidates = await call_gpt_candidates_async(self.generation_model, n)
+        screened = self._screen(n, candidates)
+        verdicts = await asyncio.gather(
+            *(batcher.check(qa_string) for qa_string, _, _ in screened)
+        )
+        self._record(n, screened, verdicts)
+
+    def _pop_new(self) -> Optional[tuple]:
+        """
+        Pops the next pooled pair and adds it to the validators' index,
+        returning None if it duplicates a pair taken earlier. Pairs are only
+        indexed when taken, right before they are journaled, so spare pairs
+        left in the pool never reject questions on a resumed run.
+        """
+        question, answer = self.accepted.popleft()
+        if self.validators is not None and not self.validators.add_accepted(
+            question, answer
+        ):
+            get_telemetry().record_outcome("rejected_duplicate")
+            return None
+        get_telemetry().record_outcome("accepted")
+        return question, answer
+
+    def take(self) -> tuple:
+        """Returns an accepted (question, answer) pair, generating more as needed."""
+        while True:
+            while not self.accepted:
+                self.refill()
+            pair = self._pop_new()
+            if pair is not None:
+                return pair
+
+    async def take_async(self, batcher: QualityCheckBatcher) -> tuple:
+        """Asynchronous version of take, with quality checks through `batcher`."""
+        while True:
+            while not self.accepted:
+                await self.refill_async(batcher)
+            pair = self._pop_new()
+            if pair is not None:
+                return pair
+
+    def close(self):
+        if self.validators is not None:
+            self.validators.close()
+
+    def print_stats(self):
+        print(
+            f"Candidate pool: {self.requests} generation requests, "
+            f"{self.generated} candidates, {self.well_formed} well-formed, "
+            f"{self.accepted_total} accepted "
+            f"({self.accepted_total / max(self.requests, 1):.2f} per request)"
+        )
+        if self.stream_stats is not None:
+            print(f"Streaming: {self.stream_stats.summary(self.accepted_total)}")
+        if self.validators is not None:
+            print(f"Local checks: {self.validators.stats()}")
 
-            checkpoint_directory_path = "data/generations/checkpoints/"
 
-            if (row + 1) % CHECKPOINT_INTERVAL == 0:
-                checkpoint_name = f"{row+1}-rows-{date}"
-                checkpoint_path = checkpoint_directory_path + checkpoint_name
-                data.to_csv(f"{checkpoint_path}.csv")
+def open_journal(journal_path=None, resume=False):
+    """
+    Opens the QA journal for a run and returns it with the rows it already
+    holds. Without `resume`, a fresh journal is started.
+    """
+    if journal_path is None:
+        date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        journal_path = f"{CHECKPOINT_DIRECTORY_PATH}journal-{date}.jsonl"
 
-            # Increment row to add next QA pair to next row in data
-            row += 1
+    journal = QAJournal(journal_path, sync_interval=CHECKPOINT_INTERVAL)
+    if resume:
+        completed = journal.load()
+        print(f"Resuming from {journal_path} with {len(completed)} rows")
+    else:
+        if os.path.exists(journal_path):
+            raise FileExistsError(
+                f"Journal already exists: {journal_path}, use --resume to continue it"
+            )
+        completed = QARowStore()
+    return journal, completed
+
+
+def make_validators(journal: QAJournal, completed: QARowStore) -> ValidationPipeline:
+    """
+    Builds the local validation pipeline for a run.
+
+    The near-duplicate index of accepted questions is saved next to the
+    journal. A resumed run reloads it, or rebuilds it from the journal if
+    it is missing; a new run starts a new one.
+    """
+    index_path = os.path.splitext(journal.path)[0] + "-minhash.bin"
+    rebuild = not os.path.exists(index_path)
+    if not completed and not rebuild:
+        os.remove(index_path)
+
+    validators = ValidationPipeline.default(QA_GENERATION_MODEL, index_path)
+    if rebuild:
+        for _, question, answer in completed.items():
+            validators.add_accepted(question, answer)
+    return validators
+
+
+def print_request_stats():
+    for deployment, stats in scheduler_stats().items():
+        print(f"Admission scheduler {deployment}: {stats}")
+    for deployment, stats in rate_limiter_stats().items():
+        print(f"Rate limiter {deployment}: {stats}")
+    print_response_cache_stats()
+
+
+def start_telemetry(date: str) -> Telemetry:
+    """Starts recording the run's calls to a JSONL events file."""
+    return configure_telemetry(f"{TELEMETRY_DIRECTORY_PATH}events-{date}.jsonl")
+
+
+def finish_telemetry(telemetry: Telemetry, date: str):
+    """Writes the run's metrics file and prints the telemetry summary."""
+    metrics_path = f"{TELEMETRY_DIRECTORY_PATH}metrics-{date}.prom"
+    telemetry.write_prometheus(metrics_path)
+    telemetry.close()
+    print(f"Telemetry: {telemetry.summary()}")
+    print(f"Telemetry saved to {telemetry.events_path} and {metrics_path}")
+
+
+def save_dataset_from_journal(journal: QAJournal, date: str):
+    print_request_stats()
+    data = journal.to_dataframe()
 
     print("Complete")
     print(data)
 
     # Write dataset to output directory
-    output_path = f"""data/generations/
-    {NUMBER_OF_QA_PAIRS}-QA-pairs-{date}"""
+    output_path = f"data/generations/{NUMBER_OF_QA_PAIRS}-QA-pairs-{date}"
     data.to_csv(f"{output_path}.csv")
     print("Dataset saved")
 
 
+def main(journal_path=None, resume=False, stream=False, local_checks=True):
+    # Get date for naming the dataset
+    date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    total_rows = NUMBER_OF_QA_PAIRS * QUESTIONS_PER_SUMMARY
+
+    # Accepted QA pairs are journaled as they are generated, so an
+    # interrupted run can pick up where it left off
+    journal, completed = open_journal(journal_path, resume)
+    telemetry = start_telemetry(date)
+
+    # Generate QUESTIONS_PER_SUMMARY reasoning questions from each
+    # discharge summary, skipping rows already in the journal
+    remaining_rows = [row for row in range(total_rows) if row not in completed]
+    candidates = CandidatePool(
+        stream=stream,
+        validators=make_validators(journal, completed) if local_checks else None,
+    )
+    from tqdm import tqdm
+
+    try:
+        for row in tqdm(remaining_rows):
+            # Take an accepted QA pair from the candidate pool, which generates
+            # and quality checks more candidates when it runs out
+            question, answer = candidates.take()
+
+            # Log the data to terminal
+            print([question, answer])
+
+            # Record the Q-A pair in the journal and the row store
+            journal.append(row, question, answer)
+            completed.add(row, question, answer)
+
+            # Output message to terminal
+            print(f"{row+1}/{total_rows}")
+    finally:
+        journal.close()
+        candidates.close()
+    candidates.print_stats()
+    finish_telemetry(telemetry, date)
+    save_dataset_from_journal(journal, date)
+
+
+async def main_async(
+    concurrency: int = CONCURRENCY_LIMIT,
+    journal_path=None,
+    resume=False,
+    stream=False,
+    local_checks=True,
+):
+    """
+    Concurrent version of main.
+
+    `concurrency` workers each run one generate/quality-check pipeline at a
+    time, so at most that many requests are in flight. Each pipeline fills a
+    fixed row, so the finished dataset is laid out the same way regardless
+    of the order in which requests complete. Accepted rows are journaled as
+    they finish, and a resumed run only generates the rows the journal is
+    missing.
+    """
+    date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    total_rows = NUMBER_OF_QA_PAIRS * QUESTIONS_PER_SUMMARY
+
+    journal, completed = open_journal(journal_path, resume)
+    telemetry = start_telemetry(date)
+    row_indices = iter([row for row in range(total_rows) if row not in completed])
+
+    from tqdm import tqdm
+
+    progress = tqdm(total=total_rows, initial=len(completed))
+    batcher = QualityCheckBatcher(
+        QUALITY_CHECKING_MODEL, max_batch_size=QUALITY_CHECK_BATCH_SIZE
+    )
+
+    candidates = CandidatePool(
+        stream=stream,
+        validators=make_validators(journal, completed) if local_checks else None,
+    )
+
+    async def worker():
+        for row in row_indices:
+            question, answer = await candidates.take_async(batcher)
+            journal.append(row, question, answer)
+            progress.update(1)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, total_rows))))
+    finally:
+        journal.close()
+        candidates.close()
+        progress.close()
+    print(f"Quality checked in {batcher.batches_sent} batched requests")
+    candidates.print_stats()
+    finish_telemetry(telemetry, date)
+
+    save_dataset_from_journal(journal, date)
+
+
+def main_batch(
+    transport=None,
+    journal_path=None,
+    resume=False,
+    batch_directory=DEFAULT_BATCH_DIRECTORY,
+    local_checks=True,
+):
+    """
+    Batch job version of main, for large runs.
+
+    Works in rounds: one batch job generates a QA string for every missing
+    row, a second quality checks the ones that pass the format and local
+    checks, and the accepted
+    pairs are journaled. Rows that were rejected are generated again in
+    the next round. Jobs go through `transport`, the Batch API of the
+    "openai" deployment pool by default.
+    """
+    date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    run_name = datetime.now().strftime("%Y-%m-%d-%H%M%S")
+    total_rows = NUMBER_OF_QA_PAIRS * QUESTIONS_PER_SUMMARY
+
+    journal, completed = open_journal(journal_path, resume)
+    telemetry = start_telemetry(date)
+    validators = make_validators(journal, completed) if local_checks else None
+    if transport is None:
+        transport = get_batch_transport("openai")
+
+    try:
+        for round_number in range(MAX_BATCH_ROUNDS):
+            remaining_rows = [row for row in range(total_rows) if row not in completed]
+            if not remaining_rows:
+                break
+            print(f"Round {round_number + 1}: {len(remaining_rows)} rows to generate")
+
+            qa_strings = run_batch(
+                {
+                    f"generate-{row}": generation_request(QA_GENERATION_MODEL)
+                    for row in remaining_rows
+                },
+                transport,
+                name=f"{run_name}-generate-{round_number}",
+                directory=batch_directory,
+            )
+            telemetry.record_outcome(
+                "rejected_failed", len(remaining_rows) - len(qa_strings)
+            )
+            screened = {}
+            for custom_id, qa_string in qa_strings.items():
+                if not is_well_formed(qa_string):
+                    telemetry.record_outcome("rejected_malformed")
+                    continue
+                rejecting_rule = (
+                    None
+                    if validators is None
+                    else validators.rejecting_rule(*parse_qa_string(qa_string))
+                )
+                if rejecting_rule is None:
+                    screened[int(custom_id.split("-")[1])] = qa_string
+                else:
+                    telemetry.record_outcome(f"rejected_{rejecting_rule}")
+            qa_strings = screened
+
+            verdicts = run_batch(
+                {
+                    f"check-{row}": quality_check_request(
+                        qa_string, QUALITY_CHECKING_MODEL
+                    )
+                    for row, qa_string in qa_strings.items()
+                },
+                transport,
+                name=f"{run_name}-check-{round_number}",
+                directory=batch_directory,
+            )
+            for row in sorted(qa_strings):
+                if "1" not in verdicts.get(f"check-{row}", ""):
+                    telemetry.record_outcome("rejected_quality_check")
+                    continue
+                question, answer = parse_qa_string(qa_strings[row])
+                if validators is None or validators.add_accepted(question, answer):
+                    telemetry.record_outcome("accepted")
+                    journal.append(row, question, answer)
+                    completed.add(row, question, answer)
+                else:
+                    telemetry.record_outcome("rejected_duplicate")
+            journal.sync()
+            print(f"{len(completed)}/{total_rows} rows accepted")
+    finally:
+        journal.close()
+        if validators is not None:
+            validators.close()
+
+    if validators is not None:
+        print(f"Local checks: {validators.stats()}")
+    finish_telemetry(telemetry, date)
+    if len(completed) < total_rows:
+        print(
+            f"Stopped after {MAX_BATCH_ROUNDS} rounds, resume with --journal "
+            f"{journal.path} --resume"
+        )
+        return
+    save_dataset_from_journal(journal, date)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Generate a QA pair dataset.")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Number of generation pipelines to run at once. 1 (default) runs "
+        f"the original serial loop; try {CONCURRENCY_LIMIT} or more to scale "
+        "with your quota.",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream generations and abort malformed ones early (interactive "
+        "mode only).",
+    )
+    parser.add_argument(
+        "--no-local-checks",
+        dest="local_checks",
+        action="store_false",
+        help="Send every well-formed candidate to the quality check, without "
+        "the local validation rules.",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["interactive", "batch"],
+        default="interactive",
+        help="Make requests interactively (default), or as Batch API jobs, "
+        "which is cheaper and slower for large runs.",
+    )
+    parser.add_argument(
+        "--batch-directory",
+        default=DEFAULT_BATCH_DIRECTORY,
+        help="Directory for batch input and result files in batch mode.",
+    )
+    parser.add_argument(
+        "--journal",
+        help="Path of the JSONL journal of accepted QA pairs. Defaults to a "
+        f"new timestamped file in {CHECKPOINT_DIRECTORY_PATH}.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the run recorded in --journal instead of starting a new one.",
+    )
+    args = parser.parse_args(argv)
+    if args.resume and args.journal is None:
+        parser.error("--resume requires --journal")
+    return args
+
+
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    if args.mode == "batch":
+        main_batch(
+            journal_path=args.journal,
+            resume=args.resume,
+            batch_directory=args.batch_directory,
+            local_checks=args.local_checks,
+        )
+    elif args.concurrency > 1:
+        asyncio.run(
+            main_async(
+                args.concurrency,
+                args.journal,
+                args.resume,
+                args.stream,
+                args.local_checks,
+            )
+        )
+    else:
+        main(args.journal, args.resume, args.stream, args.local_checks)
@@ -1,9 +1,13 @@
 # %%
 # call functions on each subset and put the result in a new json or
 # jsonl file
+import argparse
+import itertools
 import json
 import os
-from typing import Dict, Any, List, Union
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Any, Iterable, Iterator, List, Tuple, Union
 import sys
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
@@ -17,9 +21,11 @@ from utils.generation.conversion_functions import (
     convert_offensivelang,
     convert_u_math,
     convert_WMDP,
+    iter_json_items,
+    iter_offensivelang,
+    convert_offensivelang_frame,
 )
 
-
 anthropic_path = "../data/subsets/anthropic.jsonl"
 corrigibility_path = "../data/subsets/corrigibility.jsonl"
 humaneval_path = "../data/subsets/humaneval.jsonl"
@@ -39,23 +45,295 @@ def convert_dataset(
     :param conversion_function: The function to convert individual data items
     :return: A list of dictionaries in the standardized format.
     """
-    standardized_data = []
-
     if conversion_function == convert_offensivelang:
         # CSV-based conversion
-        standardized_data = convert_offensivelang(data)
+        return convert_offensivelang(data)
+
+    # JSON-based conversion
+    if isinstance(data, str):  # If data is in JSON string format
+        data = json.loads(data)
+
+    return list(iter_converted(data, conversion_function))
+
+
+def iter_converted(
+    items: Iterable[Dict[str, Any]], conversion_function
+) -> Iterator[Dict[str, str]]:
+    """
+    Lazily converts items into the standardized format, one at a time.
+
+    :param items: Iterable of input data items
+    :param conversion_function: The function to convert individual data items
+    :return: An iterator of dictionaries in the standardized format.
+    """
+    for item in items:
+        yield conversion_function(item)
+
+
+def iter_dataset(file_path: str, conversion_function) -> Iterator[Dict[str, str]]:
+    """
+    Streams a dataset file from disk and yields standardized records.
+
+    JSONL files are read line by line, JSON arrays are parsed incrementally
+    and CSV files are read in chunks, so only one record (or CSV chunk) is
+    held in memory at a time.
+
+    :param file_path: Path to a .jsonl, .json or .csv dataset
+    :param conversion_function: The function to convert individual data items
+    :return: An iterator of dictionaries in the standardized format.
+    """
+    with open(file_path, "r", encoding="utf-8") as f:
+        if conversion_function == convert_offensivelang:
+            yield from iter_offensivelang(f)
+        elif file_path.endswith(".jsonl"):
+            items = (json.loads(line) for line in f if line.strip())
+            yield from iter_converted(items, conversion_function)
+        elif file_path.endswith(".json"):
+            yield from iter_converted(iter_json_items(f), conversion_function)
+        else:
+            raise ValueError(f"Unsupported file format: {file_path}")
+
+
+def dumps_jsonl(record: Dict[str, str]) -> str:
+    """Serialises a record as a single JSONL line (without the newline)."""
+    return json.dumps(record, ensure_ascii=False)
+
+
+def dumps_json_array_item(record: Dict[str, str]) -> str:
+    """Serialises a record as an element of an indent=4 JSON array."""
+    return json.dumps(record, indent=4, ensure_ascii=False).replace("\n", "\n    ")
+
+
+def write_serialised(lines: Iterable[str], output_path: str, output_format: str) -> int:
+    """
+    Writes already-serialised records to disk as they arrive.
+
+    :param lines: Iterable of records serialised for `output_format`
+    :param output_path: Path of the file to write
+    :param output_format: "jsonl" for one record per line, "json" for an array
+    :return: The number of records written.
+    """
+    count = 0
+    with open(output_path, "w", encoding="utf-8") as f:
+        for line in lines:
+            if output_format == "jsonl":
+                f.write(line)
+                f.write("\n")
+            else:
+                f.write(",\n    " if count else "[\n    ")
+                f.write(line)
+            count += 1
+        if output_format == "json":
+            f.write("\n]" if count else "[]")
+    return count
+
+
+def write_jsonl(records: Iterable[Dict[str, str]], output_path: str) -> int:
+    """
+    Writes records to a JSONL file as they arrive.
+
+    :param records: Iterable of standardized records
+    :param output_path: Path of the JSONL file to write
+    :return: The number of records written.
+    """
+    return write_serialised(map(dumps_jsonl, records), output_path, "jsonl")
+
+
+def write_json_array(records: Iterable[Dict[str, str]], output_path: str) -> int:
+    """
+    Writes records to a JSON array file as they arrive.
+
+    The output is identical to json.dump(list(records), f, indent=4,
+    ensure_ascii=False) without building the list first.
+
+    :param records: Iterable of standardized records
+    :param output_path: Path of the JSON file to write
+    :return: The number of records written.
+    """
+    return write_serialised(map(dumps_json_array_item, records), output_path, "json")
+
+
+# Record serialisers for each output format
+SERIALISERS = {
+    "jsonl": dumps_jsonl,
+    "json": dumps_json_array_item,
+}
+
+
+def _convert_chunk(
+    kind: str, payload, conversion_function, output_format: str
+) -> List[str]:
+    """
+    Worker task: converts one chunk of a subset and returns serialised records.
+
+    :param kind: "lines" for raw JSONL lines, "items" for parsed JSON items
+                 and "frame" for a chunk of the offensivelang CSV
+    :param payload: The chunk itself
+    :param conversion_function: The function to convert individual data items
+    :param output_format: Output format the records are serialised for
+    :return: A list of serialised standardized records, in input order.
+    """
+    if kind == "frame":
+        records = convert_offensivelang_frame(payload)
+    elif kind == "lines":
+        items = (json.loads(line) for line in payload if line.strip())
+        records = iter_converted(items, conversion_function)
     else:
-        # JSON-based conversion
-        if isinstance(data, str):  # If data is in JSON string format
-            data = json.loads(data)
+        records = iter_converted(payload, conversion_function)
+
+    dumps = SERIALISERS[output_format]
+    return [dumps(record) for record in records]
+
+
+def iter_chunks(file_path: str, conversion_function, chunk_size: int):
+    """
+    Splits a dataset file into (kind, payload) chunks of up to `chunk_size` items.
+
+    JSONL lines are passed on unparsed so that decoding happens in the
+    workers as well.
+    """
+    with open(file_path, "r", encoding="utf-8") as f:
+        if conversion_function == convert_offensivelang:
+            import pandas as pd
+
+            for frame in pd.read_csv(f, chunksize=chunk_size):
+                yield "frame", frame
+            return
+
+        if file_path.endswith(".jsonl"):
+            kind, items = "lines", iter(f)
+        elif file_path.endswith(".json"):
+            kind, items = "items", iter_json_items(f)
+        else:
+            raise ValueError(f"Unsupported file format: {file_path}")
+
+        while True:
+            chunk = list(itertools.islice(items, chunk_size))
+            if not chunk:
+                return
+            yield kind, chunk
+
+
+def iter_dataset_parallel(
+    file_path: str,
+    conversion_function,
+    executor: Executor,
+    output_format: str,
+    chunk_size: int,
+    max_pending: int,
+) -> Iterator[str]:
+    """
+    Converts a dataset in chunks on `executor`, yielding serialised records in
+    input order.
+
+    At most `max_pending` chunks are in flight at once, which bounds memory
+    while keeping the workers busy.
+    """
+    pending = deque()
+    for kind, payload in iter_chunks(file_path, conversion_function, chunk_size):
+        pending.append(
+            executor.submit(
+                _convert_chunk, kind, payload, conversion_function, output_format
+            )
+        )
+        if len(pending) >= max_pending:
+            yield from pending.popleft().result()
 
-        for item in data:
-            standardized_data.append(conversion_function(item))
+    while pending:
+        yield from pending.popleft().result()
 
-    return standardized_data
+
+def convert_subsets_parallel(
+    datasets: Dict[str, Tuple[str, Any]],
+    output_paths: Dict[str, str],
+    output_format: str,
+    workers: int,
+    chunk_size: int = 10000,
+) -> Dict[str, int]:
+    """
+    Converts all subsets at once using a shared process pool.
+
+    Each subset gets its own reader/writer thread that splits the input into
+    chunks and feeds them to the pool, so small subsets run side by side and
+    large subsets are spread over several processes. Results are written in
+    input order, so the output is identical to the sequential mode.
+
+    :param datasets: Mapping of dataset name to (file path, conversion function)
+    :param output_paths: Mapping of dataset name to output path
+    :param output_format: "jsonl" or "json"
+    :param workers: Number of worker processes
+    :param chunk_size: Number of items per task sent to a worker
+    :return: Mapping of dataset name to the number of records written.
+    """
+
+    def convert_subset(name: str) -> int:
+        file_path, conversion_function = datasets[name]
+        lines = iter_dataset_parallel(
+            file_path,
+            conversion_function,
+            executor,
+            output_format,
+            chunk_size,
+            max_pending=2 * workers,
+        )
+        count = write_serialised(lines, output_paths[name], output_format)
+        print(f"Saved {count} standardized records to {output_paths[name]}")
+        return count
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        with ThreadPoolExecutor(max_workers=len(datasets) or 1) as threads:
+            futures = {name: threads.submit(convert_subset, name) for name in datasets}
+            return {name: future.result() for name, future in futures.items()}
+
+
+# Output writers and file extensions for each output format
+OUTPUT_FORMATS = {
+    "jsonl": (write_jsonl, "jsonl"),
+    "json": (write_json_array, "json"),
+}
+
+
+def positive_int(value: str) -> int:
+    """argparse type for an integer that is at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Convert the dataset subsets into the standardised format."
+    )
+    parser.add_argument(
+        "--format",
+        choices=sorted(OUTPUT_FORMATS),
+        default="jsonl",
+        help="Output format: streamed JSONL (default) or a single JSON array.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=positive_int,
+        default=1,
+        help="Number of worker processes. 1 (default) converts sequentially.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=positive_int,
+        default=10000,
+        help="Number of items per task in parallel mode.",
+    )
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
+    args = parse_args()
+    write_records, extension = OUTPUT_FORMATS[args.format]
+    workers = args.workers
+
     # Define dataset file paths and corresponding conversion functions
     datasets = {
         "anthropic": ("../data/subsets/anthropic.jsonl", convert_anthropic),
@@ -67,32 +345,32 @@ if __name__ == "__main__":
         "wmdp": ("../data/subsets/wmdp.json", convert_WMDP),
     }
 
-    for dataset_name, (file_path, conversion_function) in datasets.items():
-        print(f"Processing {dataset_name}...")
-
-        # Load dataset based on file type
-        if file_path.endswith(".jsonl"):
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = [json.loads(line) for line in f]  # Read JSONL as a list of dicts
-        elif file_path.endswith(".json"):
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)  # Read JSON as a list of dicts
-        elif file_path.endswith(".csv"):
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = f.read()  # Read CSV as a string
-        else:
+    for dataset_name, (file_path, _) in list(datasets.items()):
+        if not file_path.endswith((".jsonl", ".json", ".csv")):
             print(f"Skipping unsupported file format: {file_path}")
-            continue
+            del datasets[dataset_name]
 
-        # Convert dataset
-        standardized_data = convert_dataset(data, conversion_function)
+    output_paths = {
+        dataset_name: f"../data/Stacity/{dataset_name}_standardised.{extension}"
+        for dataset_name in datasets
+    }
+
+    if workers > 1:
+        print(f"Processing {len(datasets)} datasets with {workers} workers...")
+        convert_subsets_parallel(
+            datasets, output_paths, args.format, workers, args.chunk_size
+        )
+    else:
+        for dataset_name, (file_path, conversion_function) in datasets.items():
+            print(f"Processing {dataset_name}...")
 
-        # Save standardized output
-        output_path = f"../data/Stacity/{dataset_name}_standardised.json"
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(standardized_data, f, indent=4, ensure_ascii=False)
+            # Stream records from the input file straight into the output file
+            output_path = output_paths[dataset_name]
+            count = write_records(
+                iter_dataset(file_path, conversion_function), output_path
+            )
 
-        print(f"Saved standardized data to {output_path}")
+            print(f"Saved {count} standardized records to {output_path}")
 
     print("Conversion process completed.")
 
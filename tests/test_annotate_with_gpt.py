@@ -0,0 +1,63 @@
+from utils.evaluation.annotate_with_gpt import (
+    annotation_request,
+    packed_annotation_request,
+)
+
+# The single QA pair prompt as it was before the packed prompt was added.
+# Changing its bytes changes every annotation score, so it is pinned here.
+SYSTEM_MESSAGE = """You are an expert medical professional tasked 
+    with annotating a question-answer pair generated by a large language 
+    model based on a discharge summary from the MIMIC-III database."""
+
+
+def expected_user_prompt(discharge_summary, question, expected_answer):
+    return f"""
+        Your task is to evaluate the provided model output in 
+        response to a specific question associated with the 
+        given discharge summaries.\nBy using the correct answer 
+        also provided, you must score the answer as 0 or 1, based 
+        on the following scoring instructions.\nScoring 
+        Instructions:\n
+        1. Assign 0 points if the answer is either incorrect, or 
+        if it falsely claims there is no answer when one exists 
+        according to the discharge summaries.\n\n
+        2. Assign 0 points if the question gives away the answer to
+        the model. Be strict about this.
+        3. Assign 1 otherwise
+        4. You should only assign the output 1 if you think it is a very
+        good question-answer pair for benchmarking a clinical large
+        language model
+        
+        Please do not include any other information than the score number.\n
+        Output format:\nScore: [your score of either 0 or 1]
+        
+        Discharge Summaries:\n{discharge_summary}\n\n
+        Question: {question}\n\n
+        Correct Answer: {expected_answer}\n\n
+        
+        Score: 
+    """
+
+
+def test_single_pair_request_matches_original_prompt():
+    request = annotation_request("Summary\nwith lines", "Which drug?", "Aspirin")
+
+    assert request["messages"] == [
+        {"role": "system", "content": SYSTEM_MESSAGE},
+        {
+            "role": "user",
+            "content": expected_user_prompt(
+                "Summary\nwith lines", "Which drug?", "Aspirin"
+            ),
+        },
+    ]
+    assert request["max_tokens"] == 10
+    assert request["temperature"] == 0
+
+
+def test_packed_request_has_its_own_system_message():
+    request = packed_annotation_request("Summary", [("Q1", "A1"), ("Q2", "A2")])
+
+    system_message = request["messages"][0]["content"]
+    assert "question-answer pairs" in system_message
+    assert system_message != SYSTEM_MESSAGE
@@ -0,0 +1,62 @@
+import io
+
+import pytest
+
+from utils.generation.conversion_functions import (
+    iter_json_items,
+    iter_processed_dataset,
+    process_dataset,
+)
+
+RECORD = '{"question": "Is it?", "context": "Is it?"}'
+
+# Inputs process_dataset accepts, with its optional trailing comma
+WELL_FORMED = [
+    "",
+    "[]",
+    f"[{RECORD}]",
+    f"[{RECORD}, {RECORD}]",
+    f"[{RECORD}],",
+    f"  [ {RECORD} ] ,\n",
+    RECORD,
+    f"{RECORD},\n{RECORD}",
+    f"{RECORD},\n{RECORD},\n",
+]
+
+# Inputs process_dataset rejects with ValueError
+MALFORMED = [
+    f"[{RECORD}] junk",
+    f"[{RECORD}][{RECORD}]",
+    f"[{RECORD}],,",
+    f"[{RECORD},]",
+    f"[{RECORD},,{RECORD}]",
+    f"[{RECORD} {RECORD}]",
+    f"[,{RECORD}]",
+    f"[{RECORD}",
+    f"{RECORD}{RECORD}",
+    f"{RECORD} {RECORD}",
+    f"{RECORD},,{RECORD}",
+    f"{RECORD},,",
+    f", {RECORD}",
+    f"{RECORD}]",
+]
+
+# Read sizes that cut values and separators across reads
+CHUNK_SIZES = [1, 7, 1 << 16]
+
+
+@pytest.mark.parametrize("data", WELL_FORMED)
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_well_formed_input_matches_process_dataset(data, chunk_size):
+    records = list(iter_processed_dataset(io.StringIO(data), chunk_size))
+
+    assert records == process_dataset(data)
+
+
+@pytest.mark.parametrize("data", MALFORMED)
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_malformed_input_is_rejected_like_process_dataset(data, chunk_size):
+    with pytest.raises(ValueError):
+        process_dataset(data)
+    with pytest.raises(ValueError, match="Invalid JSON format"):
+        list(iter_json_items(io.StringIO(data), chunk_size))
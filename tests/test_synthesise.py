@@ -0,0 +1,50 @@
+import json
+
+import pytest
+
+from generation.synthesise import convert_dataset, iter_chunks, iter_dataset
+from utils.generation.conversion_functions import convert_humaneval
+
+PROBLEM = {
+    "task_id": "HumanEval/0",
+    "prompt": "def f():\n",
+    "canonical_solution": "    return 1\n",
+    "test": "assert f() == 1",
+    "entry_point": "f",
+}
+
+# Concatenated, trailing-garbage and badly separated JSON subsets
+MALFORMED = [
+    json.dumps(PROBLEM) * 2,
+    f"[{json.dumps(PROBLEM)}]\n[{json.dumps(PROBLEM)}]",
+    f"[{json.dumps(PROBLEM)}] junk",
+    f"[{json.dumps(PROBLEM)},]",
+    f"[{json.dumps(PROBLEM)},,{json.dumps(PROBLEM)}]",
+    f"[{json.dumps(PROBLEM)}",
+]
+
+
+def write_subset(tmp_path, content):
+    path = tmp_path / "humaneval.json"
+    path.write_text(content, encoding="utf-8")
+    return str(path)
+
+
+def test_json_subset_converts_like_json_load(tmp_path):
+    content = json.dumps([PROBLEM, PROBLEM], indent=4)
+    path = write_subset(tmp_path, content)
+
+    expected = convert_dataset(json.loads(content), convert_humaneval)
+    assert list(iter_dataset(path, convert_humaneval)) == expected
+    chunks = list(iter_chunks(path, convert_humaneval, chunk_size=1))
+    assert chunks == [("items", [PROBLEM]), ("items", [PROBLEM])]
+
+
+@pytest.mark.parametrize("content", MALFORMED)
+def test_malformed_json_subset_is_rejected(tmp_path, content):
+    path = write_subset(tmp_path, content)
+
+    with pytest.raises(ValueError, match="Invalid JSON format"):
+        list(iter_dataset(path, convert_humaneval))
+    with pytest.raises(ValueError, match="Invalid JSON format"):
+        list(iter_chunks(path, convert_humaneval, chunk_size=1))
@@ -0,0 +1,249 @@
+import json
+import os
+import time
+import uuid
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+# Directory for batch input and result files
+DEFAULT_BATCH_DIRECTORY = "data/batches/"
+
+# Endpoint the batch requests are made against
+BATCH_ENDPOINT = "/chat/completions"
+
+# Seconds between status checks while a batch job runs
+POLL_INTERVAL = 30.0
+
+# Number of times requests that failed inside a batch are resubmitted
+BATCH_RETRIES = 2
+
+# Batch job statuses after which the job will not change any more
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def make_batch_line(custom_id: str, request: dict) -> dict:
+    """Wraps a chat completion request as a line of a batch input file."""
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": request,
+    }
+
+
+def write_batch_input(requests: Iterable[Tuple[str, dict]], path: str) -> int:
+    """
+    Writes (custom_id, request) pairs to `path` in the Batch JSONL input
+    format and returns the number of requests written.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for custom_id, request in requests:
+            line = make_batch_line(custom_id, request)
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def iter_batch_results(path: str) -> Iterator[Tuple[str, Optional[str]]]:
+    """
+    Streams (custom_id, content) pairs from a batch result file. Content is
+    None for requests that failed.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200:
+                yield result["custom_id"], None
+                continue
+            choices = response["body"]["choices"]
+            yield result["custom_id"], choices[0]["message"]["content"]
+
+
+class OpenAIBatchTransport:
+    """
+    Runs batch jobs through the OpenAI/Azure OpenAI Batch API of `client`.
+    """
+
+    def __init__(self, client, completion_window: str = "24h"):
+        self.client = client
+        self.completion_window = completion_window
+
+    def submit(self, input_path: str) -> str:
+        with open(input_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=self.completion_window,
+        )
+        return batch.id
+
+    def status(self, job_id: str) -> str:
+        return self.client.batches.retrieve(job_id).status
+
+    def download(self, job_id: str, output_path: str):
+        """Streams the job's result and error files into `output_path`."""
+        batch = self.client.batches.retrieve(job_id)
+        with open(output_path, "wb") as f:
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id is None:
+                    continue
+                with self.client.files.with_streaming_response.content(
+                    file_id
+                ) as response:
+                    for chunk in response.iter_bytes():
+                        f.write(chunk)
+
+
+class LocalFileTransport:
+    """
+    File-based stand-in for the Batch API, for tests and dry runs.
+
+    Submitted input files are answered locally by `responder`, which takes
+    a request body and returns the message content (or raises to make that
+    request fail). Jobs report "in_progress" for `polls_until_complete`
+    status checks before completing.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        responder: Callable[[dict], str],
+        polls_until_complete: int = 0,
+    ):
+        self.directory = directory
+        self.responder = responder
+        self.polls_until_complete = polls_until_complete
+        self._polls = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id: str, kind: str) -> str:
+        return os.path.join(self.directory, f"{job_id}-{kind}.jsonl")
+
+    def submit(self, input_path: str) -> str:
+        job_id = f"batch_{uuid.uuid4().hex}"
+        with open(input_path, "rb") as source, open(
+            self._path(job_id, "input"), "wb"
+        ) as target:
+            target.write(source.read())
+        self._polls[job_id] = 0
+        return job_id
+
+    def status(self, job_id: str) -> str:
+        if self._polls[job_id] < self.polls_until_complete:
+            self._polls[job_id] += 1
+            return "in_progress"
+        if not os.path.exists(self._path(job_id, "output")):
+            self._run(job_id)
+        return "completed"
+
+    def _run(self, job_id: str):
+        with open(self._path(job_id, "input"), "r", encoding="utf-8") as source, open(
+            self._path(job_id, "output"), "w", encoding="utf-8"
+        ) as target:
+            for line in source:
+                request = json.loads(line)
+                try:
+                    content = self.responder(request["body"])
+                except Exception as e:
+                    result = {
+                        "custom_id": request["custom_id"],
+                        "response": None,
+                        "error": {"code": "local_error", "message": str(e)},
+                    }
+                else:
+                    result = {
+                        "custom_id": request["custom_id"],
+                        "response": {
+                            "status_code": 200,
+                            "body": {
+                                "object": "chat.completion",
+                                "model": request["body"].get("model"),
+                                "choices": [
+                                    {
+                                        "index": 0,
+                                        "message": {
+                                            "role": "assistant",
+                                            "content": content,
+                                        },
+                                        "finish_reason": "stop",
+                                    }
+                                ],
+                            },
+                        },
+                        "error": None,
+                    }
+                target.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+    def download(self, job_id: str, output_path: str):
+        with open(self._path(job_id, "output"), "rb") as source, open(
+            output_path, "wb"
+        ) as target:
+            target.write(source.read())
+
+
+def run_batch(
+    requests: Dict[str, dict],
+    transport,
+    name: str,
+    directory: str = DEFAULT_BATCH_DIRECTORY,
+    poll_interval: float = POLL_INTERVAL,
+    retries: int = BATCH_RETRIES,
+) -> Dict[str, str]:
+    """
+    Runs {custom_id: request} as a batch job and returns {custom_id:
+    content} for every request that succeeded.
+
+    The input file is written to `directory`, submitted through
+    `transport` and polled until the job finishes, then the result file is
+    streamed back and joined to the requests by custom_id. Requests that
+    failed inside the job are resubmitted up to `retries` times.
+    """
+    results = {}
+    pending = dict(requests)
+    for attempt in range(0, retries + 1):
+        if not pending:
+            break
+
+        input_path = os.path.join(directory, f"{name}-{attempt}-input.jsonl")
+        output_path = os.path.join(directory, f"{name}-{attempt}-output.jsonl")
+        write_batch_input(pending.items(), input_path)
+
+        job_id = transport.submit(input_path)
+        print(f"Submitted batch job {job_id} with {len(pending)} requests")
+
+        status = transport.status(job_id)
+        while status not in TERMINAL_STATUSES:
+            time.sleep(poll_interval)
+            status = transport.status(job_id)
+        if status != "completed":
+            raise RuntimeError(f"Batch job {job_id} ended with status '{status}'")
+
+        transport.download(job_id, output_path)
+        for custom_id, content in iter_batch_results(output_path):
+            if content is not None and custom_id in pending:
+                results[custom_id] = content
+                del pending[custom_id]
+
+    if pending:
+        print(f"{len(pending)} requests failed in batch {name}")
+    return results
+
+
+def get_batch_transport(pool_name: str) -> OpenAIBatchTransport:
+    """
+    Returns a Batch API transport for the first deployment of a pool. The
+    deployment needs a batch (Global-Batch) model deployment.
+    """
+    # Imported here so the file-based transport works without any
+    # deployments configured
+    from utils.deployments import get_deployment_pool
+
+    return OpenAIBatchTransport(get_deployment_pool(pool_name).deployments[0].client())
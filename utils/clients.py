@@ -0,0 +1,86 @@
+import asyncio
+import threading
+import weakref
+from typing import TYPE_CHECKING
+
+# openai and httpx are imported when the first client is created, so that
+# importing this module is cheap
+if TYPE_CHECKING:
+    import httpx
+    from openai import AsyncAzureOpenAI, AzureOpenAI
+
+# Connection pool settings shared by all clients. Keep-alive connections
+# are reused across calls so that each request does not pay for a new TCP
+# connection and TLS handshake. The SDK's own retries are disabled because
+# utils.rate_limiter retries throttled and failed requests.
+MAX_CONNECTIONS = 100
+MAX_KEEPALIVE_CONNECTIONS = 50
+KEEPALIVE_EXPIRY = 60.0
+
+_lock = threading.Lock()
+_clients = {}
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _connection_limits() -> "httpx.Limits":
+    import httpx
+
+    return httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+
+
+def get_client(azure_endpoint, api_key, api_version) -> "AzureOpenAI":
+    """
+    Returns the process-wide AzureOpenAI client for a deployment.
+
+    Clients are created once per (endpoint, api version, key) and then
+    reused. The underlying httpx connection pool is thread-safe, so the same
+    client can be shared between threads.
+    """
+    key = (azure_endpoint, api_version, api_key)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                from openai import AzureOpenAI, DefaultHttpxClient
+
+                client = AzureOpenAI(
+                    azure_endpoint=azure_endpoint,
+                    api_key=api_key,
+                    api_version=api_version,
+                    max_retries=0,
+                    http_client=DefaultHttpxClient(limits=_connection_limits()),
+                )
+                _clients[key] = client
+    return client
+
+
+def get_async_client(azure_endpoint, api_key, api_version) -> "AsyncAzureOpenAI":
+    """
+    Returns the shared AsyncAzureOpenAI client for a deployment.
+
+    Async connection pools are tied to the event loop they were opened on,
+    so async clients are kept per running loop and released along with it.
+    All tasks on the same loop share one client.
+    """
+    loop = asyncio.get_running_loop()
+    key = (azure_endpoint, api_version, api_key)
+    with _lock:
+        loop_clients = _async_clients.setdefault(loop, {})
+        client = loop_clients.get(key)
+        if client is None:
+            from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
+
+            client = AsyncAzureOpenAI(
+                azure_endpoint=azure_endpoint,
+                api_key=api_key,
+                api_version=api_version,
+                max_retries=0,
+                http_client=DefaultAsyncHttpxClient(limits=_connection_limits()),
+            )
+            loop_clients[key] = client
+    return client
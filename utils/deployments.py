@@ -0,0 +1,493 @@
+import asyncio
+import functools
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from typing import Any, Callable, Dict, List, Optional
+from utils.clients import get_async_client, get_client
+from utils.rate_limiter import (
+    MAX_RETRIES,
+    AdaptiveRateLimiter,
+    get_rate_limiter,
+    is_rate_limit_error,
+    retryable_errors,
+)
+from utils.response_cache import get_response_cache
+from utils.scheduler import AdmissionScheduler, get_scheduler
+from utils.telemetry import get_telemetry
+
+# JSON file describing the deployments of each pool, for example:
+# {"openai": [{"endpoint": "https://...", "api_key_env": "KEY_1",
+#              "tokens_per_minute": 120000, "requests_per_minute": 720}]}
+DEPLOYMENTS_FILE_ENV = "LLM_DEPLOYMENTS_FILE"
+
+# Environment variables used for each pool when no deployments file is set.
+# The endpoint and key variables may hold comma-separated lists to define
+# several deployments.
+POOL_ENV_VARS = {
+    "openai": ("AZURE_OPENAI_ENDPOINT", "AZURE_OPENAI_KEY"),
+    "gpt-4o": ("AZURE_GPT_4O_ENDPOINT", "AZURE_GPT_4O_API_KEY"),
+}
+
+# Circuit breaker: open after this many consecutive failures and keep
+# requests away for CIRCUIT_COOLDOWN seconds before trying again
+FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN = 30.0
+
+
+class Deployment:
+    """
+    One Azure OpenAI endpoint, with its quota and circuit breaker state.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        api_key: str,
+        api_version: str,
+        tokens_per_minute: Optional[float] = None,
+        requests_per_minute: Optional[float] = None,
+    ):
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.api_version = api_version
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+
+        self.consecutive_failures = 0
+        self.circuit_open_until = 0.0
+        self.successes = 0
+        self.failures = 0
+
+    def client(self):
+        return get_client(self.endpoint, self.api_key, self.api_version)
+
+    @property
+    def base_url(self) -> str:
+        return str(self.client().base_url)
+
+    def async_client(self):
+        return get_async_client(self.endpoint, self.api_key, self.api_version)
+
+    def limiter(self, model_name) -> AdaptiveRateLimiter:
+        # Limiters and schedulers are keyed by endpoint, so any client for
+        # this deployment finds the same ones
+        return get_rate_limiter(self.client(), model_name)
+
+    def scheduler(self, model_name) -> AdmissionScheduler:
+        return get_scheduler(
+            self.client(),
+            model_name,
+            self.tokens_per_minute,
+            self.requests_per_minute,
+        )
+
+    def is_available(self, model_name, now: float) -> bool:
+        """Whether the circuit is closed and no Retry-After pause is active."""
+        return (
+            now >= self.circuit_open_until
+            and self.limiter(model_name).paused_for() == 0
+        )
+
+
+class DeploymentPool:
+    """
+    Routes requests across several deployments of the same models.
+
+    Each request goes to the available deployment with the fewest
+    outstanding requests relative to its adaptive concurrency limit, with
+    ties going to the one reporting the most quota left. A deployment that
+    fails FAILURE_THRESHOLD times in a row has its circuit opened and is
+    skipped for CIRCUIT_COOLDOWN seconds, after which it gets trial
+    requests again (half-open). Throttled deployments are skipped while
+    their Retry-After pause lasts, so their load moves to the others.
+    """
+
+    def __init__(self, name: str, deployments: List[Deployment]):
+        if not deployments:
+            raise ValueError(f"Deployment pool '{name}' has no deployments")
+        self.name = name
+        self.deployments = deployments
+        self._lock = threading.Lock()
+
+    def choose(self, model_name) -> Deployment:
+        now = time.monotonic()
+        available = [
+            d for d in self.deployments if d.is_available(model_name, now)
+        ] or [
+            # Everything is unavailable: use whichever recovers first
+            min(
+                self.deployments,
+                key=lambda d: max(
+                    d.circuit_open_until - now, d.limiter(model_name).paused_for()
+                ),
+            )
+        ]
+
+        def score(deployment):
+            limiter = deployment.limiter(model_name)
+            remaining = limiter.remaining_fraction
+            return (limiter.load(), -(1.0 if remaining is None else remaining))
+
+        return min(available, key=score)
+
+    @property
+    def base_url(self) -> str:
+        """
+        Base URLs of the pool's deployments, which the response cache keys
+        on. Deployments in a pool serve the same models, so a response from
+        any of them can answer a request routed to another.
+        """
+        return ",".join(sorted({d.base_url for d in self.deployments}))
+
+    def has_alternative(self, deployment: Deployment, model_name) -> bool:
+        now = time.monotonic()
+        return any(
+            d is not deployment and d.is_available(model_name, now)
+            for d in self.deployments
+        )
+
+    def record_success(self, deployment: Deployment):
+        with self._lock:
+            deployment.successes += 1
+            deployment.consecutive_failures = 0
+            deployment.circuit_open_until = 0.0
+
+    def record_failure(self, deployment: Deployment):
+        with self._lock:
+            deployment.failures += 1
+            deployment.consecutive_failures += 1
+            if deployment.consecutive_failures >= FAILURE_THRESHOLD:
+                if deployment.circuit_open_until <= time.monotonic():
+                    print(
+                        f"Opening circuit for {deployment.endpoint} after "
+                        f"{deployment.consecutive_failures} failures"
+                    )
+                deployment.circuit_open_until = time.monotonic() + CIRCUIT_COOLDOWN
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                d.endpoint: {
+                    "successes": d.successes,
+                    "failures": d.failures,
+                    "circuit_open": d.circuit_open_until > now,
+                }
+                for d in self.deployments
+            }
+
+
+def _load_deployments_file(path: str) -> Dict[str, List[Deployment]]:
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    pools = {}
+    for pool_name, entries in config.items():
+        pools[pool_name] = [
+            Deployment(
+                endpoint=entry["endpoint"],
+                api_key=entry.get("api_key") or os.getenv(entry["api_key_env"]),
+                api_version=entry.get("api_version") or os.getenv("AZURE_API_VERSION"),
+                tokens_per_minute=entry.get("tokens_per_minute"),
+                requests_per_minute=entry.get("requests_per_minute"),
+            )
+            for entry in entries
+        ]
+    return pools
+
+
+def _deployments_from_env(pool_name: str) -> List[Deployment]:
+    endpoint_var, key_var = POOL_ENV_VARS[pool_name]
+    endpoints = [e.strip() for e in (os.getenv(endpoint_var) or "").split(",")]
+    keys = [k.strip() for k in (os.getenv(key_var) or "").split(",")]
+    if len(keys) == 1:
+        keys = keys * len(endpoints)
+    if len(keys) != len(endpoints):
+        raise ValueError(
+            f"{endpoint_var} and {key_var} list different numbers of deployments"
+        )
+
+    return [
+        Deployment(endpoint, key, os.getenv("AZURE_API_VERSION"))
+        for endpoint, key in zip(endpoints, keys)
+    ]
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def load_environment():
+    """
+    Loads variables from .env into the environment, once, when the first
+    deployment pool is needed rather than at import time.
+    """
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+
+def get_deployment_pool(pool_name: str) -> DeploymentPool:
+    """
+    Returns the process-wide pool of deployments called `pool_name`.
+
+    Pools come from the JSON file named by LLM_DEPLOYMENTS_FILE if it is
+    set, otherwise from the endpoint/key environment variables in
+    POOL_ENV_VARS.
+    """
+    with _pools_lock:
+        pool = _pools.get(pool_name)
+        if pool is None:
+            load_environment()
+            deployments_file = os.getenv(DEPLOYMENTS_FILE_ENV)
+            if deployments_file:
+                deployments = _load_deployments_file(deployments_file)[pool_name]
+            else:
+                deployments = _deployments_from_env(pool_name)
+            pool = DeploymentPool(pool_name, deployments)
+            _pools[pool_name] = pool
+    return pool
+
+
+# Result of a streamed request: the response headers, for the rate limiter,
+# whatever the consumer of the stream returned, and the usage from the final
+# chunk if the stream was read that far
+_Streamed = namedtuple("_Streamed", ["headers", "result", "usage"])
+
+
+def _stream(completions, consume, **request):
+    raw_response = completions.with_raw_response.create(
+        stream=True, stream_options={"include_usage": True}, **request
+    )
+    stream = raw_response.parse()
+    usage = []
+
+    def chunks():
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                usage.append(chunk.usage)
+            yield chunk
+
+    try:
+        result = consume(chunks())
+        return _Streamed(raw_response.headers, result, usage[-1] if usage else None)
+    finally:
+        # Closing the connection stops the generation if consume returned
+        # before the end of the stream
+        stream.close()
+
+
+async def _stream_async(completions, consume, **request):
+    raw_response = await completions.with_raw_response.create(
+        stream=True, stream_options={"include_usage": True}, **request
+    )
+    stream = raw_response.parse()
+    usage = []
+
+    async def chunks():
+        async for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                usage.append(chunk.usage)
+            yield chunk
+
+    try:
+        result = await consume(chunks())
+        return _Streamed(raw_response.headers, result, usage[-1] if usage else None)
+    finally:
+        await stream.close()
+
+
+def _record_call(label, request, started, retries, throttled, deployment, outcome):
+    """
+    Records a _create call in the telemetry. `outcome` is the parsed
+    response, or for streams the _Streamed result, or None on failure.
+    Streams closed before their final chunk carry no usage.
+    """
+    get_telemetry().record_call(
+        label,
+        request["model"],
+        time.monotonic() - started,
+        usage=getattr(outcome, "usage", None),
+        retries=retries,
+        throttled=throttled,
+        failed=outcome is None,
+        deployment=deployment.endpoint if deployment is not None else None,
+    )
+
+
+def _create(pool: DeploymentPool, request: dict, consume=None, label=None):
+    """
+    Sends a chat completion request through the deployment pool and returns
+    the parsed response, or with `consume`, streams the response and
+    returns consume(stream).
+
+    Each attempt is routed to a deployment and goes through that
+    deployment's admission scheduler and rate limiter. Throttled and
+    failed attempts are retried straight away on another deployment when
+    one is available, and after a backoff otherwise. The call is recorded
+    in the telemetry under `label`.
+    """
+    model_name = request["model"]
+    started = time.monotonic()
+    throttled = 0
+    deployment = outcome = None
+    attempt = 0
+    try:
+        for attempt in range(0, MAX_RETRIES):
+            deployment = pool.choose(model_name)
+            client = deployment.client()
+            limiter = deployment.limiter(model_name)
+
+            if consume is None:
+                request_function = client.chat.completions.with_raw_response.create
+            else:
+                request_function = functools.partial(
+                    _stream, client.chat.completions, consume
+                )
+
+            deployment.scheduler(model_name).admit(request)
+            try:
+                raw_response = limiter.attempt(request_function, **request)
+            except retryable_errors() as e:
+                throttled += is_rate_limit_error(e)
+                pool.record_failure(deployment)
+                delay = limiter.retry_delay(attempt, e)
+                if not pool.has_alternative(deployment, model_name):
+                    time.sleep(delay)
+                continue
+
+            pool.record_success(deployment)
+            outcome = raw_response.parse() if consume is None else raw_response
+            return outcome if consume is None else raw_response.result
+    finally:
+        _record_call(label, request, started, attempt, throttled, deployment, outcome)
+
+    raise RuntimeError("Maximum retries exceeded.")
+
+
+async def _create_async(pool: DeploymentPool, request: dict, consume=None, label=None):
+    """Asynchronous version of _create."""
+    model_name = request["model"]
+    started = time.monotonic()
+    throttled = 0
+    deployment = outcome = None
+    attempt = 0
+    try:
+        for attempt in range(0, MAX_RETRIES):
+            deployment = pool.choose(model_name)
+            client = deployment.async_client()
+            limiter = deployment.limiter(model_name)
+
+            if consume is None:
+                request_function = client.chat.completions.with_raw_response.create
+            else:
+                request_function = functools.partial(
+                    _stream_async, client.chat.completions, consume
+                )
+
+            await deployment.scheduler(model_name).admit_async(request)
+            try:
+                raw_response = await limiter.attempt_async(request_function, **request)
+            except retryable_errors() as e:
+                throttled += is_rate_limit_error(e)
+                pool.record_failure(deployment)
+                delay = limiter.retry_delay(attempt, e)
+                if not pool.has_alternative(deployment, model_name):
+                    await asyncio.sleep(delay)
+                continue
+
+            pool.record_success(deployment)
+            outcome = raw_response.parse() if consume is None else raw_response
+            return outcome if consume is None else raw_response.result
+    finally:
+        _record_call(label, request, started, attempt, throttled, deployment, outcome)
+
+    raise RuntimeError("Maximum retries exceeded.")
+
+
+def _cached(pool: DeploymentPool, label, request) -> Optional[str]:
+    cache = get_response_cache()
+    if cache is None:
+        return None
+    cached = cache.lookup(request, pool.base_url)
+    if cached is not None:
+        get_telemetry().record_call(label, request["model"], 0.0, cached=True)
+    return cached
+
+
+def chat_completion(pool: DeploymentPool, label: str = None, **request) -> str:
+    """
+    Makes a chat completion request through the response cache and the
+    deployment pool, and returns the message content. `label` names the
+    kind of call in the telemetry.
+    """
+    cached = _cached(pool, label, request)
+    if cached is not None:
+        return cached
+
+    content = _create(pool, request, label=label).choices[0].message.content
+    cache = get_response_cache()
+    if cache is not None:
+        cache.store(request, content, pool.base_url)
+    return content
+
+
+async def chat_completion_async(
+    pool: DeploymentPool, label: str = None, **request
+) -> str:
+    """Asynchronous version of chat_completion."""
+    cached = _cached(pool, label, request)
+    if cached is not None:
+        return cached
+
+    response = await _create_async(pool, request, label=label)
+    content = response.choices[0].message.content
+    cache = get_response_cache()
+    if cache is not None:
+        cache.store(request, content, pool.base_url)
+    return content
+
+
+def chat_completion_choices(
+    pool: DeploymentPool, label: str = None, **request
+) -> List[str]:
+    """
+    Makes a chat completion request, usually with n > 1, through the
+    deployment pool and returns the content of every choice. Responses are
+    not cached.
+    """
+    response = _create(pool, request, label=label)
+    return [choice.message.content for choice in response.choices]
+
+
+async def chat_completion_choices_async(
+    pool: DeploymentPool, label: str = None, **request
+) -> List[str]:
+    """Asynchronous version of chat_completion_choices."""
+    response = await _create_async(pool, request, label=label)
+    return [choice.message.content for choice in response.choices]
+
+
+def chat_completion_stream(
+    pool: DeploymentPool, consume: Callable, label: str = None, **request
+):
+    """
+    Makes a streaming chat completion request through the deployment pool
+    and returns consume(stream), where the stream yields completion chunks.
+
+    The stream is closed once consume returns, so consume can stop reading
+    early to abort a generation that is going wrong. Responses are not
+    cached.
+    """
+    return _create(pool, request, consume, label)
+
+
+async def chat_completion_stream_async(
+    pool: DeploymentPool, consume: Callable, label: str = None, **request
+):
+    """Asynchronous version of chat_completion_stream, with an async consume."""
+    return await _create_async(pool, request, consume, label)
@@ -1,28 +1,58 @@
-import os
-from openai import AzureOpenAI
-from dotenv import load_dotenv
-
-load_dotenv()
+import asyncio
+import re
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+from utils.batch_jobs import DEFAULT_BATCH_DIRECTORY, get_batch_transport, run_batch
+from utils.deployments import (
+    chat_completion,
+    chat_completion_async,
+    get_deployment_pool,
+)
+from utils.misc import count_tokens, pack_by_token_budget, parse_numbered_lines
 
 ANNOTATION_MODEL = "gpt-4o"
 
+# Prompt token budget for one packed annotation request, below the model's
+# context window
+PACKED_TOKEN_BUDGET = 100000
 
-def annotate_with_gpt(
-    discharge_summary,
-    question,
-    expected_answer,
-):
+# Upper bound on the number of QA pairs annotated in one packed request
+MAX_PACKED_QUESTIONS = 20
+
+# Completion tokens reserved for each "[n] Score: x" line
+SCORE_TOKENS_PER_ITEM = 10
+
+# Matches indexed score lines such as "[3] Score: 1" or "3: Score: 0"
+PACKED_SCORE_PATTERN = re.compile(
+    r"^\s*\[?(\d+)\]?\s*[:.)-]?\s*Score:\s*([01])", re.MULTILINE
+)
 
-    client = AzureOpenAI(
-        azure_endpoint=os.getenv("AZURE_GPT_4O_ENDPOINT"),
-        api_key=os.getenv("AZURE_GPT_4O_API_KEY"),
-        api_version=os.getenv("AZURE_API_VERSION"),
-    )
 
-    system_message = """You are an expert medical professional tasked 
+# System message of the single QA pair annotation request
+ANNOTATION_SYSTEM_MESSAGE = """You are an expert medical professional tasked 
     with annotating a question-answer pair generated by a large language 
     model based on a discharge summary from the MIMIC-III database."""
 
+# System message of the packed annotation request
+PACKED_ANNOTATION_SYSTEM_MESSAGE = """You are an expert medical professional tasked 
+    with annotating question-answer pairs generated by a large language 
+    model based on a discharge summary from the MIMIC-III database."""
+
+
+def _request(system_message, user_prompt, max_tokens) -> dict:
+    return dict(
+        model=ANNOTATION_MODEL,
+        messages=[
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": user_prompt},
+        ],
+        max_tokens=max_tokens,
+        temperature=0,
+    )
+
+
+def annotation_request(discharge_summary, question, expected_answer) -> dict:
+    """Builds the chat completion request for annotating one QA pair."""
     user_prompt = f"""
         Your task is to evaluate the provided model output in 
         response to a specific question associated with the 
@@ -49,15 +79,220 @@ def annotate_with_gpt(
         
         Score: 
     """
+    return _request(ANNOTATION_SYSTEM_MESSAGE, user_prompt, max_tokens=10)
 
-    response = client.chat.completions.create(
-        model=ANNOTATION_MODEL,
-        messages=[
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": user_prompt},
-        ],
-        max_tokens=10,
-        temperature=0,
+
+def annotate_with_gpt(
+    discharge_summary,
+    question,
+    expected_answer,
+):
+    return chat_completion(
+        get_deployment_pool("gpt-4o"),
+        label="annotation",
+        **annotation_request(discharge_summary, question, expected_answer),
+    )
+
+
+async def annotate_with_gpt_async(
+    discharge_summary,
+    question,
+    expected_answer,
+):
+    """Asynchronous version of annotate_with_gpt."""
+    return await chat_completion_async(
+        get_deployment_pool("gpt-4o"),
+        label="annotation",
+        **annotation_request(discharge_summary, question, expected_answer),
+    )
+
+
+def annotate_dataset_with_gpt(
+    items: Iterable[Tuple[str, str, str]],
+    mode: str = "interactive",
+    transport=None,
+    batch_directory: str = DEFAULT_BATCH_DIRECTORY,
+) -> List[Optional[str]]:
+    """
+    Annotates (discharge_summary, question, expected_answer) items and
+    returns one response per item, in order.
+
+    In "interactive" mode each item is sent with annotate_with_gpt. In
+    "batch" mode all items are submitted as one batch job through
+    `transport` (the Batch API of the gpt-4o pool by default), and items
+    whose request failed get None.
+    """
+    if mode == "interactive":
+        return [annotate_with_gpt(*item) for item in items]
+    if mode != "batch":
+        raise ValueError(f"Unknown annotation mode: {mode}")
+
+    requests = {
+        f"annotation-{index}": annotation_request(*item)
+        for index, item in enumerate(items)
+    }
+    results = run_batch(
+        requests,
+        transport or get_batch_transport("gpt-4o"),
+        name=f"annotation-{datetime.now().strftime('%Y-%m-%d-%H%M%S')}",
+        directory=batch_directory,
     )
+    return [results.get(custom_id) for custom_id in requests]
+
+
+def _numbered_pair(number, qa_pair) -> str:
+    question, expected_answer = qa_pair
+    return f"[{number}]\nQuestion: {question}\nCorrect Answer: {expected_answer}"
+
+
+def packed_annotation_request(discharge_summary, qa_pairs) -> dict:
+    """
+    Builds one chat completion request that annotates several (question,
+    expected_answer) pairs about the same discharge summary, which is only
+    included once.
+    """
+    numbered_pairs = "\n\n".join(
+        _numbered_pair(number, qa_pair)
+        for number, qa_pair in enumerate(qa_pairs, start=1)
+    )
+    user_prompt = f"""
+        Your task is to evaluate each of the numbered question-answer 
+        pairs below, which are all associated with the given discharge 
+        summaries.\nYou must score each pair as 0 or 1, based on the 
+        following scoring instructions.\nScoring Instructions:\n
+        1. Assign 0 points if the answer is either incorrect, or 
+        if it falsely claims there is no answer when one exists 
+        according to the discharge summaries.\n\n
+        2. Assign 0 points if the question gives away the answer to
+        the model. Be strict about this.
+        3. Assign 1 otherwise
+        4. You should only assign the output 1 if you think it is a very
+        good question-answer pair for benchmarking a clinical large
+        language model
+        
+        Score every pair, one per line, and do not include any other 
+        information.\n
+        Output format:\n[number] Score: [your score of either 0 or 1]
+        
+        Discharge Summaries:\n{discharge_summary}\n\n
+        Question-Answer Pairs:\n{numbered_pairs}\n\n
+    """
+
+    return _request(
+        PACKED_ANNOTATION_SYSTEM_MESSAGE,
+        user_prompt,
+        max_tokens=SCORE_TOKENS_PER_ITEM * len(qa_pairs),
+    )
+
+
+def split_annotation_groups(
+    discharge_summary,
+    qa_pairs: List[Tuple[str, str]],
+    token_budget: int = PACKED_TOKEN_BUDGET,
+    max_group_size: int = MAX_PACKED_QUESTIONS,
+) -> List[List[int]]:
+    """
+    Groups the QA pairs about one discharge summary into packed requests,
+    keeping the summary and each group's pairs within `token_budget`, see
+    pack_by_token_budget. Returns a list of groups of indices into
+    `qa_pairs`.
+    """
+    request = packed_annotation_request(discharge_summary, [])
+    base_tokens = sum(
+        count_tokens(message["content"], ANNOTATION_MODEL)
+        for message in request["messages"]
+    )
+    return pack_by_token_budget(
+        qa_pairs,
+        lambda number, qa_pair: _numbered_pair(number, qa_pair) + "\n\n",
+        base_tokens,
+        ANNOTATION_MODEL,
+        token_budget,
+        max_group_size,
+    )
+
+
+def parse_packed_scores(response: str, group_size: int) -> Dict[int, str]:
+    """
+    Parses indexed score lines into {position: "Score: x"}, in the form a
+    single annotation returns, see parse_numbered_lines.
+    """
+    scores = parse_numbered_lines(response, group_size, PACKED_SCORE_PATTERN)
+    return {position: f"Score: {score}" for position, score in scores.items()}
+
+
+def annotate_packed_with_gpt(
+    discharge_summary, qa_pairs: List[Tuple[str, str]]
+) -> List[str]:
+    """
+    Annotates several (question, expected_answer) pairs about one
+    discharge summary, sending the summary once per group of pairs.
+
+    Returns one response per pair, in order. Pairs whose score cannot be
+    read from the packed response are annotated on their own.
+    """
+    responses = [None] * len(qa_pairs)
+    for group in split_annotation_groups(discharge_summary, qa_pairs):
+        group_pairs = [qa_pairs[i] for i in group]
+        if len(group) == 1:
+            parsed = {}
+        else:
+            response = chat_completion(
+                get_deployment_pool("gpt-4o"),
+                label="annotation",
+                **packed_annotation_request(discharge_summary, group_pairs),
+            )
+            parsed = parse_packed_scores(response, len(group))
+
+        for position, index in enumerate(group):
+            if position in parsed:
+                responses[index] = parsed[position]
+            else:
+                responses[index] = annotate_with_gpt(
+                    discharge_summary, *qa_pairs[index]
+                )
+    return responses
+
+
+async def annotate_packed_with_gpt_async(
+    discharge_summary, qa_pairs: List[Tuple[str, str]]
+) -> List[str]:
+    """
+    Asynchronous version of annotate_packed_with_gpt. Groups are sent
+    concurrently.
+    """
+
+    async def annotate_group(group: List[int]) -> List[str]:
+        group_pairs = [qa_pairs[i] for i in group]
+        if len(group) == 1:
+            parsed = {}
+        else:
+            response = await chat_completion_async(
+                get_deployment_pool("gpt-4o"),
+                label="annotation",
+                **packed_annotation_request(discharge_summary, group_pairs),
+            )
+            parsed = parse_packed_scores(response, len(group))
+
+        # Fall back to single annotations for anything that could not be
+        # parsed
+        fallback = [
+            position for position in range(len(group)) if position not in parsed
+        ]
+        fallback_responses = await asyncio.gather(
+            *(
+                annotate_with_gpt_async(discharge_summary, *group_pairs[position])
+                for position in fallback
+            )
+        )
+        parsed.update(zip(fallback, fallback_responses))
+        return [parsed[position] for position in range(len(group))]
+
+    groups = split_annotation_groups(discharge_summary, qa_pairs)
+    results = await asyncio.gather(*(annotate_group(group) for group in groups))
 
-    return response.choices[0].message.content
+    responses = [None] * len(qa_pairs)
+    for group, group_responses in zip(groups, results):
+        for index, response in zip(group, group_responses):
+            responses[index] = response
+    return responses
@@ -3,47 +3,254 @@
 # Prompt model to generate a question and answer based on the context
 # with specifications and requirements for the type of question
 
-import os
 import time
-from openai import AzureOpenAI
-from dotenv import load_dotenv
-from azure.core.exceptions import HttpResponseError
+from typing import List
+from utils.deployments import (
+    chat_completion,
+    chat_completion_async,
+    chat_completion_choices,
+    chat_completion_choices_async,
+    chat_completion_stream,
+    chat_completion_stream_async,
+    get_deployment_pool,
+)
 from utils.generation.prompts import get_generation_prompt
+from utils.misc import percentile
 
-load_dotenv()
+# Markers of the two parts of a generated QA string
+QUESTION_MARKER = "Part 1:"
+ANSWER_MARKER = "Part 2:"
+
+# Streamed generations are aborted if the question marker has not appeared
+# within this many tokens, or if the answer runs past this many tokens
+STREAM_QUESTION_WITHIN_TOKENS: int = 50
+STREAM_MAX_ANSWER_TOKENS: int = 400
+
+
+def generation_request(model_name, n=1) -> dict:
+    """
+    Builds the chat completion request for generating a QA pair, or `n`
+    candidate QA pairs from one prompt.
+    """
+    system_message, user_prompt = get_generation_prompt()
+    request = dict(
+        model=model_name,
+        messages=[
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": user_prompt},
+        ],
+        max_tokens=999,
+        temperature=1,
+    )
+    if n > 1:
+        request["n"] = n
+    return request
 
 
 def call_gpt(model_name):
 
-    max_retries = 10
-    retry_delay = 5
+    # Routing, retries and rate limiting are handled by the deployment pool
+    return chat_completion(
+        get_deployment_pool("openai"),
+        label="generation",
+        **generation_request(model_name),
+    )
 
-    client = AzureOpenAI(
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        api_key=os.getenv("AZURE_OPENAI_KEY"),
-        api_version=os.getenv("AZURE_API_VERSION"),
+
+async def call_gpt_async(model_name):
+    """Asynchronous version of call_gpt for use with concurrent generation."""
+
+    return await chat_completion_async(
+        get_deployment_pool("openai"),
+        label="generation",
+        **generation_request(model_name),
     )
 
-    system_message, user_prompt = get_generation_prompt()
 
-    for i in range(0, max_retries):
-        try:
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": user_prompt},
-                ],
-                max_tokens=999,
-                temperature=1,
+def call_gpt_candidates(model_name, n) -> List[str]:
+    """
+    Generates `n` candidate QA strings in a single request, so the prompt
+    is only sent (and paid for) once.
+    """
+    return chat_completion_choices(
+        get_deployment_pool("openai"),
+        label="generation",
+        **generation_request(model_name, n),
+    )
+
+
+async def call_gpt_candidates_async(model_name, n) -> List[str]:
+    """Asynchronous version of call_gpt_candidates."""
+    return await chat_completion_choices_async(
+        get_deployment_pool("openai"),
+        label="generation",
+        **generation_request(model_name, n),
+    )
+
+
+class StreamStats:
+    """
+    Counters for streamed generations, shared by the calls of one run.
+
+    Tokens are counted as streamed content chunks, which the API sends one
+    token at a time.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.candidates = 0
+        self.aborted = 0
+        self.streamed_tokens = 0
+        self.first_usable_token_seconds = []
+
+    def summary(self, accepted_pairs: int) -> dict:
+        latencies = sorted(self.first_usable_token_seconds) or [0.0]
+        return {
+            "requests": self.requests,
+            "candidates": self.candidates,
+            "aborted": self.aborted,
+            "streamed_tokens": self.streamed_tokens,
+            "tokens_per_accepted_pair": (
+                self.streamed_tokens / accepted_pairs if accepted_pairs else None
+            ),
+            "first_usable_token_p50": percentile(latencies, 50),
+            "first_usable_token_p95": percentile(latencies, 95),
+        }
+
+
+class _CandidateReader:
+    """
+    Incremental format check of the candidates in a streamed response.
+
+    A candidate is marked malformed as soon as its question marker is
+    missing after `question_within` tokens or its answer runs past
+    `max_answer_tokens`. Reading can stop once every candidate is either
+    finished or malformed.
+    """
+
+    def __init__(self, n, started, stats, question_within, max_answer_tokens):
+        self.texts = [""] * n
+        self.tokens = [0] * n
+        self.answer_start = [None] * n
+        self.first_token_at = [None] * n
+        self.open = set(range(n))
+        self.malformed = set()
+        self.started = started
+        self.stats = stats
+        self.question_within = question_within
+        self.max_answer_tokens = max_answer_tokens
+
+    def feed(self, chunk):
+        # Azure sends chunks without choices, e.g. for content filter results
+        for choice in chunk.choices:
+            i = choice.index
+            if i not in self.open:
+                continue
+
+            content = choice.delta.content
+            if content:
+                if self.first_token_at[i] is None:
+                    self.first_token_at[i] = time.monotonic()
+                self.texts[i] += content
+                self.tokens[i] += 1
+                self.stats.streamed_tokens += 1
+                self._check(i)
+
+            if choice.finish_reason is not None:
+                self.open.discard(i)
+
+    def _check(self, i):
+        text = self.texts[i]
+        if QUESTION_MARKER not in text:
+            if self.tokens[i] >= self.question_within:
+                self._abort(i)
+        elif ANSWER_MARKER in text:
+            if self.answer_start[i] is None:
+                self.answer_start[i] = self.tokens[i]
+            elif self.tokens[i] - self.answer_start[i] > self.max_answer_tokens:
+                self._abort(i)
+
+    def _abort(self, i):
+        self.open.discard(i)
+        self.malformed.add(i)
+        self.stats.aborted += 1
+
+    def finished(self) -> bool:
+        return not self.open
+
+    def can_stop(self) -> bool:
+        """
+        Whether the rest of the stream can be dropped: every candidate is
+        finished or malformed and one was aborted, so the rest is wasted
+        tokens. Otherwise the stream is read to its final usage chunk.
+        """
+        return self.finished() and bool(self.malformed)
+
+    def result(self) -> List[str]:
+        usable = [i for i in range(len(self.texts)) if i not in self.malformed]
+        first_tokens = [
+            self.first_token_at[i] for i in usable if self.first_token_at[i]
+        ]
+        if first_tokens:
+            self.stats.first_usable_token_seconds.append(
+                min(first_tokens) - self.started
             )
-            return response.choices[0].message.content
-
-        except HttpResponseError as e:
-            if "429" in str(e):
-                print(f"Rate limit exceeded. Attempt {i + 1} of {max_retries}.")
-                time.sleep(retry_delay)
-                retry_delay *= 2
-            else:
-                raise
-        raise RuntimeError("Maximum retries exceeded.")
+        return [self.texts[i] for i in usable]
+
+
+def _streaming_request(model_name, n, stats):
+    stats.requests += 1
+    stats.candidates += n
+    request = generation_request(model_name, n)
+    started = time.monotonic()
+
+    def new_reader():
+        # Each attempt reads its stream from scratch, so a retry after a
+        # stream failed partway does not append to the partial candidates
+        return _CandidateReader(
+            n,
+            started,
+            stats,
+            STREAM_QUESTION_WITHIN_TOKENS,
+            STREAM_MAX_ANSWER_TOKENS,
+        )
+
+    return request, new_reader
+
+
+def call_gpt_streaming(model_name, n=1, stats=None) -> List[str]:
+    """
+    Streams `n` candidate QA strings and returns the ones that were not
+    aborted as malformed. Reading stops, and the request is closed, as
+    soon as every candidate is finished or malformed and one was aborted.
+    """
+    request, new_reader = _streaming_request(model_name, n, stats or StreamStats())
+
+    def consume(stream):
+        reader = new_reader()
+        for chunk in stream:
+            reader.feed(chunk)
+            if reader.can_stop():
+                break
+        return reader.result()
+
+    return chat_completion_stream(
+        get_deployment_pool("openai"), consume, label="generation", **request
+    )
+
+
+async def call_gpt_streaming_async(model_name, n=1, stats=None) -> List[str]:
+    """Asynchronous version of call_gpt_streaming."""
+    request, new_reader = _streaming_request(model_name, n, stats or StreamStats())
+
+    async def consume(stream):
+        reader = new_reader()
+        async for chunk in stream:
+            reader.feed(chunk)
+            if reader.can_stop():
+                break
+        return reader.result()
+
+    return await chat_completion_stream_async(
+        get_deployment_pool("openai"), consume, label="generation", **request
+    )
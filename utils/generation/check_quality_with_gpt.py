@@ -1,44 +1,251 @@
-import os
-import time
+import asyncio
+import re
+from typing import Dict, List
 from utils.generation.prompts import (
+    get_batch_qual_check_prompt,
     get_qual_check_prompt,
 )
-from openai import AzureOpenAI
-from dotenv import load_dotenv
-from azure.core.exceptions import HttpResponseError
-
-load_dotenv()
+from utils.misc import count_tokens, pack_by_token_budget, parse_numbered_lines
+from utils.deployments import (
+    chat_completion,
+    chat_completion_async,
+    get_deployment_pool,
+)
 
 
 def check_quality_with_gpt(qa_string, model_name):
-    max_retries = 10
-    retry_delay = 5
-
-    client = AzureOpenAI(
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        api_key=os.getenv("AZURE_OPENAI_KEY"),
-        api_version=os.getenv("AZURE_API_VERSION"),
+    return chat_completion(
+        get_deployment_pool("openai"),
+        label="quality_check",
+        **quality_check_request(qa_string, model_name),
     )
 
+
+def quality_check_request(qa_string, model_name) -> dict:
+    """Builds the chat completion request for quality checking one QA pair."""
     system_message, user_prompt = get_qual_check_prompt(qa_string)
+    return _request(system_message, user_prompt, model_name, max_tokens=10)
 
-    for i in range(0, max_retries):
-        try:
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": user_prompt},
-                ],
-                max_tokens=10,
-                temperature=1,
+
+def _request(system_message, user_prompt, model_name, max_tokens) -> dict:
+    return dict(
+        model=model_name,
+        messages=[
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": user_prompt},
+        ],
+        max_tokens=max_tokens,
+        temperature=1,
+    )
+
+
+def _complete(system_message, user_prompt, model_name, max_tokens):
+    # Routing, retries and rate limiting are handled by the deployment pool
+    return chat_completion(
+        get_deployment_pool("openai"),
+        label="quality_check",
+        **_request(system_message, user_prompt, model_name, max_tokens),
+    )
+
+
+async def check_quality_with_gpt_async(qa_string, model_name):
+    """Asynchronous version of check_quality_with_gpt."""
+    return await chat_completion_async(
+        get_deployment_pool("openai"),
+        label="quality_check",
+        **quality_check_request(qa_string, model_name),
+    )
+
+
+async def _complete_async(system_message, user_prompt, model_name, max_tokens):
+    return await chat_completion_async(
+        get_deployment_pool("openai"),
+        label="quality_check",
+        **_request(system_message, user_prompt, model_name, max_tokens),
+    )
+
+
+# Prompt token budget for a single batched quality check request
+BATCH_TOKEN_BUDGET = 6000
+
+# Upper bound on the number of QA strings checked in one request
+MAX_BATCH_SIZE = 20
+
+# Completion tokens reserved for each "[n]: verdict" line
+VERDICT_TOKENS_PER_ITEM = 8
+
+# Matches verdict lines such as "[3]: 1", "3: 1" or "3. 0"
+VERDICT_PATTERN = re.compile(r"^\s*\[?(\d+)\]?\s*[:.)-]\s*(.+?)\s*$", re.MULTILINE)
+
+
+def split_into_batches(
+    qa_strings: List[str],
+    model_name: str,
+    token_budget: int = BATCH_TOKEN_BUDGET,
+    max_batch_size: int = MAX_BATCH_SIZE,
+) -> List[List[int]]:
+    """
+    Groups QA strings into batches that fit in one quality check request.
+
+    Batches are filled greedily in order, using count_tokens to keep each
+    batch prompt within `token_budget`. A QA string that is too long for the
+    budget on its own still gets a batch of its own.
+
+    Returns a list of batches of indices into `qa_strings`.
+    """
+    system_message, user_prompt = get_batch_qual_check_prompt([])
+    return pack_by_token_budget(
+        qa_strings,
+        lambda number, qa_string: f"[{number}]\n{qa_string}\n\n",
+        count_tokens(system_message + user_prompt, model_name),
+        model_name,
+        token_budget,
+        max_batch_size,
+    )
+
+
+def parse_batch_verdicts(response: str, batch_size: int) -> Dict[int, str]:
+    """
+    Parses an indexed list of verdicts into {position: verdict}, see
+    parse_numbered_lines.
+    """
+    return parse_numbered_lines(response, batch_size, VERDICT_PATTERN)
+
+
+def check_quality_batch_with_gpt(qa_strings: List[str], model_name) -> List[str]:
+    """
+    Quality checks many QA strings with as few requests as possible.
+
+    Returns one verdict per QA string, in the same order and in the same
+    form check_quality_with_gpt returns. Any QA string whose verdict cannot
+    be parsed from the batched response is re-checked on its own.
+    """
+    verdicts = [None] * len(qa_strings)
+    for batch in split_into_batches(qa_strings, model_name):
+        batch_qa_strings = [qa_strings[i] for i in batch]
+
+        if len(batch) == 1:
+            parsed = {}
+        else:
+            system_message, user_prompt = get_batch_qual_check_prompt(batch_qa_strings)
+            response = _complete(
+                system_message,
+                user_prompt,
+                model_name,
+                max_tokens=VERDICT_TOKENS_PER_ITEM * len(batch),
             )
-            return response.choices[0].message.content
-        except HttpResponseError as e:
-            if "429" in str(e):
-                print(f"Rate limit exceeded. Attempt {i + 1} of {max_retries}.")
-                time.sleep(retry_delay)
-                retry_delay *= 2
+            parsed = parse_batch_verdicts(response, len(batch))
+
+        for position, index in enumerate(batch):
+            if position in parsed:
+                verdicts[index] = parsed[position]
             else:
-                raise
-        raise RuntimeError("Maximum retries exceeded.")
+                verdicts[index] = check_quality_with_gpt(qa_strings[index], model_name)
+
+    return verdicts
+
+
+async def check_quality_batch_with_gpt_async(
+    qa_strings: List[str], model_name
+) -> List[str]:
+    """
+    Asynchronous version of check_quality_batch_with_gpt. Batches are sent
+    concurrently.
+    """
+
+    async def check_batch(batch: List[int]) -> List[str]:
+        batch_qa_strings = [qa_strings[i] for i in batch]
+
+        if len(batch) == 1:
+            parsed = {}
+        else:
+            system_message, user_prompt = get_batch_qual_check_prompt(batch_qa_strings)
+            response = await _complete_async(
+                system_message,
+                user_prompt,
+                model_name,
+                max_tokens=VERDICT_TOKENS_PER_ITEM * len(batch),
+            )
+            parsed = parse_batch_verdicts(response, len(batch))
+
+        # Fall back to single checks for anything that could not be parsed
+        fallback = [
+            position for position in range(len(batch)) if position not in parsed
+        ]
+        fallback_verdicts = await asyncio.gather(
+            *(
+                check_quality_with_gpt_async(batch_qa_strings[position], model_name)
+                for position in fallback
+            )
+        )
+        parsed.update(zip(fallback, fallback_verdicts))
+        return [parsed[position] for position in range(len(batch))]
+
+    batches = split_into_batches(qa_strings, model_name)
+    results = await asyncio.gather(*(check_batch(batch) for batch in batches))
+
+    verdicts = [None] * len(qa_strings)
+    for batch, batch_verdicts in zip(batches, results):
+        for index, verdict in zip(batch, batch_verdicts):
+            verdicts[index] = verdict
+    return verdicts
+
+
+class QualityCheckBatcher:
+    """
+    Collects quality checks from concurrent tasks into batched requests.
+
+    Each call to `check` waits until `max_batch_size` QA strings are pending
+    or `max_wait` seconds have passed since the first one arrived, then the
+    pending QA strings are checked together with
+    check_quality_batch_with_gpt_async.
+    """
+
+    def __init__(self, model_name, max_batch_size=MAX_BATCH_SIZE, max_wait=0.05):
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches_sent = 0
+        self._pending = []
+        self._timer = None
+        # The event loop only keeps weak references to tasks
+        self._tasks = set()
+
+    async def check(self, qa_string: str) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((qa_string, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        pending, self._pending = self._pending, []
+        if pending:
+            self.batches_sent += 1
+            task = asyncio.ensure_future(self._check_pending(pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _check_pending(self, pending):
+        try:
+            verdicts = await check_quality_batch_with_gpt_async(
+                [qa_string for qa_string, _ in pending], self.model_name
+            )
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), verdict in zip(pending, verdicts):
+            if not future.done():
+                future.set_result(verdict)
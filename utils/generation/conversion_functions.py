@@ -1,11 +1,15 @@
 # %%
 
-from typing import Dict, List, Any
-import pandas as pd
+from typing import TYPE_CHECKING, Dict, List, Any, Iterator, TextIO
 import io
 import json
 import os
 
+# pandas is only imported by the CSV converters that use it, so the JSON
+# converters start quickly
+if TYPE_CHECKING:
+    import pandas as pd
+
 
 def convert_statement_format(data: Dict[str, Any]) -> Dict[str, str]:
     """
@@ -274,51 +278,243 @@ def convert_offensivelang(csv_content: str) -> List[Dict[str, str]]:
 
     Returns a list of standardized format dictionaries, one for each row.
     """
+    import pandas as pd
+
     # Read CSV content
     df = pd.read_csv(io.StringIO(csv_content))
 
-    standardized_data = []
-
-    for _, row in df.iterrows():
-        # Create context with metadata
-        context_parts = [
-            f"Category: {row['Category']}",
-            f"Target Group: {row['Target Group']}",
-            "Individual Annotations:",
-            f"- OpenAI: {row['OpenAI_Annotation']}",
-            f"- Annotator 1: {row['Annotator1']}",
-            f"- Annotator 2: {row['Annotator2']}",
-            f"- Annotator 3: {row['Annotator3']}",
-        ]
+    return list(convert_offensivelang_frame(df))
 
-        # Create the question format
-        question = "Is the following text offensive or not offensive?"
 
-        # Get all non-matching annotations (different from final annotation)
-        all_annotations = [
-            row["OpenAI_Annotation"],
-            row["Annotator1"],
-            row["Annotator2"],
-            row["Annotator3"],
-        ]
-        not_matching_annotations = [
-            annot for annot in all_annotations if annot != row["Final Annotation"]
-        ]
+# Individual annotation columns and their labels in the offensivelang context
+OFFENSIVELANG_ANNOTATORS = [
+    ("OpenAI_Annotation", "OpenAI"),
+    ("Annotator1", "Annotator 1"),
+    ("Annotator2", "Annotator 2"),
+    ("Annotator3", "Annotator 3"),
+]
+
+
+def convert_offensivelang_frame(df: "pd.DataFrame") -> Iterator[Dict[str, str]]:
+    """
+    Yields a standardized dictionary for each row of an offensivelang DataFrame.
+
+    The context and non-matching annotation strings are built column-wise
+    for the whole frame, rather than row by row.
+    """
+
+    import pandas as pd
+
+    def text(column: str) -> pd.Series:
+        # Same formatting as an f-string, including "nan" for empty cells
+        return df[column].map(str)
+
+    # Create context with metadata
+    context = (
+        "Text: "
+        + text("Text")
+        + "\n\nCategory: "
+        + text("Category")
+        + "\nTarget Group: "
+        + text("Target Group")
+        + "\nIndividual Annotations:"
+    )
+    for column, label in OFFENSIVELANG_ANNOTATORS:
+        context = context + f"\n- {label}: " + text(column)
+
+    # Get all non-matching annotations (different from final annotation),
+    # each followed by a ", " separator that is trimmed off at the end
+    final_annotation = df["Final Annotation"]
+    any_not_matching = pd.Series(False, index=df.index)
+    not_matching = pd.Series("", index=df.index, dtype=object)
+    for column, _ in OFFENSIVELANG_ANNOTATORS:
+        is_not_matching = df[column] != final_annotation
+        # Joining the annotations fails on empty (NaN) or non-string cells,
+        # rather than writing them to the output as NaN
+        invalid = is_not_matching & ~df[column].map(
+            lambda value: isinstance(value, str)
+        )
+        if invalid.any():
+            value = df[column][invalid].iloc[0]
+            raise TypeError(
+                f"{column} annotation must be a string, got {type(value).__name__}"
+                f" {value!r} in row {invalid.idxmax()}"
+            )
+        any_not_matching |= is_not_matching
+        not_matching = (
+            not_matching
+            + df[column].where(is_not_matching, "")
+            + (is_not_matching.map({True: ", ", False: ""}))
+        )
+
+    not_matching = ("Alternative annotations: " + not_matching.str[:-2]).where(
+        any_not_matching, "No alternative annotations"
+    )
+
+    # Create the question format
+    question = "Is the following text offensive or not offensive?"
 
-        standardized = {
+    for context_text, answer, not_matching_text in zip(
+        context.tolist(), final_annotation.tolist(), not_matching.tolist()
+    ):
+        yield {
             "question": question,
-            "context": f"Text: {row['Text']}\n\n" + "\n".join(context_parts),
-            "answer_matching_behavior": row["Final Annotation"],
-            "answer_not_matching_behavior": (
-                f"Alternative annotations: {', '.join(not_matching_annotations)}"
-                if not_matching_annotations
-                else "No alternative annotations"
-            ),
+            "context": context_text,
+            "answer_matching_behavior": answer,
+            "answer_not_matching_behavior": not_matching_text,
         }
 
-        standardized_data.append(standardized)
 
-    return standardized_data
+def iter_offensivelang(
+    csv_file: TextIO, chunksize: int = 10000
+) -> Iterator[Dict[str, str]]:
+    """
+    Streaming counterpart of convert_offensivelang.
+
+    Reads the annotation CSV in chunks of `chunksize` rows and yields one
+    standardized dictionary per row, so memory use does not grow with the
+    size of the file.
+    """
+    import pandas as pd
+
+    for chunk in pd.read_csv(csv_file, chunksize=chunksize):
+        yield from convert_offensivelang_frame(chunk)
+
+
+# Characters allowed around top-level JSON values
+_JSON_WHITESPACE = " \t\r\n"
+
+
+def iter_json_items(f: TextIO, chunk_size: int = 1 << 16) -> Iterator[Any]:
+    """
+    Lazily yield the top-level values of a JSON file without loading it whole.
+
+    Accepts the same input as process_dataset: a regular JSON array, or a
+    bare sequence of values separated by single commas, either optionally
+    followed by one trailing comma. Anything else raises ValueError, which
+    may come after the values before it were yielded. Memory is bounded by
+    the largest single value plus one read chunk.
+
+    Args:
+        f (TextIO): Open text file to read from
+        chunk_size (int): Number of characters to read at a time
+
+    Returns:
+        Iterator over the parsed values
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    offset = 0  # Position of buffer[0] in the file
+    eof = False
+    bracketed = None
+    # What may come next: "start" (a value, or the end), "separator" (after
+    # a value), "value" (after a comma), "closed" (after the closing
+    # bracket) or "end" (after the trailing comma)
+    expecting = "start"
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in _JSON_WHITESPACE:
+            pos += 1
+
+        if pos == len(buffer):
+            if eof:
+                break
+            offset += len(buffer)
+            buffer = f.read(chunk_size)
+            pos = 0
+            eof = not buffer
+            continue
+
+        # Work out whether the values are wrapped in an array
+        if bracketed is None:
+            bracketed = buffer[pos] == "["
+            if bracketed:
+                pos += 1
+            continue
+
+        char = buffer[pos]
+        if char == "," and expecting in ("separator", "start", "closed"):
+            if expecting == "separator":
+                expecting = "value"
+            elif expecting == "closed" or not bracketed:
+                expecting = "end"
+            else:
+                raise ValueError(
+                    f"Invalid JSON format: unexpected ',' at char {offset + pos}"
+                )
+            pos += 1
+            continue
+
+        if char == "]" and bracketed and expecting in ("start", "separator"):
+            expecting = "closed"
+            pos += 1
+            continue
+
+        if expecting not in ("start", "value"):
+            raise ValueError(
+                f"Invalid JSON format: unexpected {char!r} at char {offset + pos}"
+            )
+
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as e:
+            if eof:
+                raise ValueError(f"Invalid JSON format: {str(e)}")
+            end = None
+
+        # The value may be cut off at the end of the buffer, read more
+        if end is None or (end == len(buffer) and not eof):
+            chunk = f.read(max(chunk_size, len(buffer) - pos))
+            eof = not chunk
+            offset += pos
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+
+        yield item
+        pos = end
+        expecting = "separator"
+
+    if bracketed and expecting not in ("closed", "end"):
+        raise ValueError("Invalid JSON format: unterminated array")
+
+
+# Prefix of the Anthropic persona questions, stripped before comparing the
+# statement with its context
+_STATEMENT_PREFIX = "Is the following statement something you would say?\n"
+
+
+def process_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Apply the 'context' rules to a single record, returning a new record.
+
+    Args:
+        item (dict): Record with 'question' and 'context' properties
+
+    Returns:
+        dict: Processed record
+    """
+    # Get the question without the prefix if it exists
+    question_text = item["question"]
+    if question_text.startswith(_STATEMENT_PREFIX):
+        actual_question = question_text.replace(_STATEMENT_PREFIX, "")
+    else:
+        actual_question = question_text
+
+    # Case 1: Context is a repetition of the statement in the question
+    if item["context"] == actual_question.strip('"'):
+        return {key: value for key, value in item.items() if key != "context"}
+
+    # Case 2: Context contains options like "(A) Yes\n (B) No"
+    if item["context"].startswith("(A)"):
+        new_item = {key: value for key, value in item.items() if key != "context"}
+        new_item["question"] = item["question"] + "\n" + item["context"]
+        return new_item
+
+    # Keep track of any other cases we find
+    print(f"Found different context format: {item['context']}")
+    return dict(item)
 
 
 def process_dataset(data_str):
@@ -345,44 +541,36 @@ def process_dataset(data_str):
     except json.JSONDecodeError as e:
         raise ValueError(f"Invalid JSON format: {str(e)}")
 
-    processed_data = []
-
-    for item in data:
-        new_item = item.copy()
-
-        # Get the question without the prefix if it exists
-        question_text = item["question"]
-        if question_text.startswith(
-            "Is the following statement something you would say?\n"
-        ):
-            actual_question = question_text.replace(
-                "Is the following statement something you would say?\n", ""
-            )
-        else:
-            actual_question = question_text
+    return [process_item(item) for item in data]
 
-        # Case 1: Context is a repetition of the statement in the question
-        if item["context"] == actual_question.strip('"'):
-            del new_item["context"]
 
-        # Case 2: Context contains options like "(A) Yes\n (B) No"
-        elif item["context"].startswith("(A)"):
-            new_item["question"] = item["question"] + "\n" + item["context"]
-            del new_item["context"]
+def iter_processed_dataset(f: TextIO, chunk_size: int = 1 << 16) -> Iterator[dict]:
+    """
+    Lazily process a JSON dataset one record at a time.
 
-        # Keep track of any other cases we find
-        else:
-            print(f"Found different context format: {item['context']}")
+    Accepts the same input as process_dataset (a JSON array, or bare
+    comma-separated records with an optional trailing comma), with memory
+    bounded by the largest single record.
 
-        processed_data.append(new_item)
+    Args:
+        f (TextIO): Open text file to read from
+        chunk_size (int): Number of characters to read at a time
 
-    return processed_data
+    Returns:
+        Iterator over the processed records
+    """
+    for item in iter_json_items(f, chunk_size):
+        yield process_item(item)
 
 
 def process_file(input_path, output_path=None):
     """
     Process a JSON file and save the results to a new file.
 
+    Records are parsed, processed and written one at a time, so the file is
+    never loaded whole. The output is identical to json.dump(process_dataset(
+    ...), f, indent=2) and only replaces `output_path` once complete.
+
     Args:
         input_path (str): Path to the input JSON file
         output_path (str, optional): Path for the output JSON file.
@@ -400,21 +588,26 @@ def process_file(input_path, output_path=None):
         base, ext = os.path.splitext(input_path)
         output_path = f"{base}_processed{ext}"
 
-    # Read and process the file
+    # Read, process and write the records as they are parsed
+    temporary_path = f"{output_path}.tmp"
     try:
-        with open(input_path, "r", encoding="utf-8") as f:
-            data_str = f.read()
-
-        processed_data = process_dataset(data_str)
-
-        # Write the processed data to the output file
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(processed_data, f, indent=2)
+        with open(input_path, "r", encoding="utf-8") as f_in, open(
+            temporary_path, "w", encoding="utf-8"
+        ) as f_out:
+            count = 0
+            for new_item in iter_processed_dataset(f_in):
+                f_out.write(",\n  " if count else "[\n  ")
+                f_out.write(json.dumps(new_item, indent=2).replace("\n", "\n  "))
+                count += 1
+            f_out.write("\n]" if count else "[]")
+        os.replace(temporary_path, output_path)
 
         print(f"Successfully processed file. Output saved to: {output_path}")
         return output_path
 
     except Exception as e:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
         print(f"Error processing file: {str(e)}")
         raise
 
@@ -0,0 +1,72 @@
+import json
+import os
+from typing import TYPE_CHECKING
+from utils.generation.row_store import QARowStore
+from utils.misc import load_jsonl_log
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Number of appended QA pairs between fsyncs of the journal
+DEFAULT_SYNC_INTERVAL = 5
+
+
+class QAJournal:
+    """
+    Append-only JSONL journal of accepted QA pairs.
+
+    Every accepted pair is written once, as {"row", "question", "answer"},
+    and the file is fsynced every `sync_interval` appends. A crashed or
+    interrupted run can be resumed by loading the journal, which replays
+    the recorded rows and drops a partially written last line.
+    """
+
+    def __init__(self, path: str, sync_interval: int = DEFAULT_SYNC_INTERVAL):
+        self.path = path
+        self.sync_interval = sync_interval
+        self._unsynced = 0
+        self._file = None
+
+    def load(self) -> QARowStore:
+        """
+        Returns a QARowStore holding every pair in the journal.
+
+        If the last line was only partly written, it is truncated away so
+        that later appends start on a clean line. A corrupt line anywhere
+        else raises ValueError rather than dropping the pairs after it.
+        """
+        rows = QARowStore()
+        for entry in load_jsonl_log(self.path, "journal entry"):
+            rows.add(entry["row"], entry["question"], entry["answer"])
+        return rows
+
+    def append(self, row: int, question: str, answer: str):
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+
+        entry = {"row": row, "question": question, "answer": answer}
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+        self._unsynced += 1
+        if self._unsynced >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        if self._file is not None and self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def to_dataframe(self) -> "pd.DataFrame":
+        """Builds the dataset from the journal, ordered by row."""
+        self.sync()
+        return self.load().to_dataframe()
@@ -0,0 +1,216 @@
+import os
+import zlib
+from typing import Optional, Tuple
+import numpy as np
+
+# Number of MinHash permutations, and the number of LSH bands they are split
+# into. With 16 bands of 4 rows, pairs with a similarity of 0.8 share a
+# bucket with a probability of over 0.999.
+NUM_PERMUTATIONS = 64
+NUM_BANDS = 16
+
+# Estimated Jaccard similarity of character shingles above which two
+# questions count as near-duplicates
+SIMILARITY_THRESHOLD = 0.8
+
+# Length of the character shingles questions are split into
+SHINGLE_LENGTH = 5
+
+# Number of entries buffered before they are merged into the sorted bucket
+# arrays
+MERGE_INTERVAL = 4096
+
+# Prime modulus of the MinHash permutations (the largest prime below 2**32),
+# so signatures fit in uint32
+_PRIME = np.uint64(4294967291)
+
+
+def shingles(text: str, length: int = SHINGLE_LENGTH) -> set:
+    text = " ".join(text.lower().split())
+    if len(text) <= length:
+        return {text}
+    return {text[i : i + length] for i in range(len(text) - length + 1)}
+
+
+class MinHashLSHIndex:
+    """
+    Incremental MinHash-LSH index for near-duplicate lookups.
+
+    Each text gets a MinHash signature over its character shingles. The
+    signature is cut into bands, and texts with an identical band are
+    candidate duplicates, whose similarity is then estimated from their
+    full signatures. Band keys are kept per band in sorted numpy arrays
+    that are searched with binary search, plus a small unsorted buffer of
+    recent entries, so lookups stay fast and memory stays compact with
+    hundreds of thousands of entries.
+
+    With `path`, signatures are appended to that file as they are added,
+    and a new index on the same path starts from the saved entries.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        num_permutations: int = NUM_PERMUTATIONS,
+        num_bands: int = NUM_BANDS,
+        threshold: float = SIMILARITY_THRESHOLD,
+        seed: int = 0,
+    ):
+        if num_permutations % num_bands:
+            raise ValueError("num_permutations must be a multiple of num_bands")
+        self.num_permutations = num_permutations
+        self.num_bands = num_bands
+        self.threshold = threshold
+
+        random_state = np.random.RandomState(seed)
+        self._a = random_state.randint(1, 2**32 - 5, num_permutations).astype(np.uint64)
+        self._b = random_state.randint(0, 2**32 - 5, num_permutations).astype(np.uint64)
+        self._band_multipliers = random_state.randint(
+            1, 2**62, num_permutations // num_bands
+        ).astype(np.uint64)
+
+        self._signatures = np.empty((1024, num_permutations), dtype=np.uint32)
+        self._size = 0
+        self._sorted_keys = np.empty((num_bands, 0), dtype=np.uint64)
+        self._sorted_ids = np.empty((num_bands, 0), dtype=np.int64)
+        self._pending_keys = np.empty((MERGE_INTERVAL, num_bands), dtype=np.uint64)
+        self._num_pending = 0
+
+        self.path = path
+        self._file = None
+        if path is not None:
+            self._load(path)
+            self._file = open(path, "ab")
+
+    def __len__(self) -> int:
+        return self._size
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles(text)),
+            dtype=np.uint64,
+        )
+        # (a * h + b) mod p is computed exactly in uint64, without wrapping:
+        # a, b and h reduced mod p are all below 2**32 - 5, so a * h + b is
+        # below 2**64. Reducing h first leaves the result unchanged.
+        hashes %= _PRIME
+        permuted = (self._a[:, None] * hashes[None, :] + self._b[:, None]) % _PRIME
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signatures: np.ndarray) -> np.ndarray:
+        # Hash each band's rows into one uint64 key, wrapping on overflow.
+        # Colliding keys only add candidates, which are then verified.
+        bands = signatures.reshape(len(signatures), self.num_bands, -1)
+        return (bands.astype(np.uint64) * self._band_multipliers).sum(axis=2)
+
+    def query(self, text: str) -> Optional[Tuple[int, float]]:
+        """
+        Returns (entry id, estimated similarity) of the most similar entry at
+        or above the threshold, or None.
+        """
+        return self._query_signature(self.signature(text))
+
+    def _query_signature(self, signature: np.ndarray) -> Optional[Tuple[int, float]]:
+        keys = self._band_keys(signature[None, :])[0]
+
+        candidates = []
+        for band in range(self.num_bands):
+            band_keys = self._sorted_keys[band]
+            lower = np.searchsorted(band_keys, keys[band], side="left")
+            upper = np.searchsorted(band_keys, keys[band], side="right")
+            if upper > lower:
+                candidates.append(self._sorted_ids[band, lower:upper])
+        if self._num_pending:
+            pending = self._pending_keys[: self._num_pending]
+            matches = np.nonzero((pending == keys).any(axis=1))[0]
+            if len(matches):
+                candidates.append(matches + (self._size - self._num_pending))
+        if not candidates:
+            return None
+
+        candidate_ids = np.unique(np.concatenate(candidates))
+        similarities = (self._signatures[candidate_ids] == signature).mean(axis=1)
+        best = int(similarities.argmax())
+        if similarities[best] < self.threshold:
+            return None
+        return int(candidate_ids[best]), float(similarities[best])
+
+    def add(self, text: str) -> int:
+        """Adds a text to the index and returns its entry id."""
+        return self._store(self.signature(text))
+
+    def add_if_new(self, text: str) -> bool:
+        """
+        Adds a text unless it is a near-duplicate of an entry. Returns
+        whether it was added.
+        """
+        signature = self.signature(text)
+        if self._query_signature(signature) is not None:
+            return False
+        self._store(signature)
+        return True
+
+    def _store(self, signature: np.ndarray) -> int:
+        if self._file is not None:
+            self._file.write(signature.tobytes())
+            self._file.flush()
+        return self._add_signatures(signature[None, :])
+
+    def _add_signatures(self, signatures: np.ndarray) -> int:
+        count = len(signatures)
+        if self._size + count > len(self._signatures):
+            capacity = max(2 * len(self._signatures), self._size + count)
+            grown = np.empty((capacity, self.num_permutations), dtype=np.uint32)
+            grown[: self._size] = self._signatures[: self._size]
+            self._signatures = grown
+        self._signatures[self._size : self._size + count] = signatures
+        self._size += count
+
+        keys = self._band_keys(signatures)
+        if self._num_pending + count > MERGE_INTERVAL:
+            self._merge(keys)
+        else:
+            self._pending_keys[self._num_pending : self._num_pending + count] = keys
+            self._num_pending += count
+        return self._size - 1
+
+    def _merge(self, new_keys: np.ndarray):
+        """
+        Merges the pending entries and `new_keys`, the band keys of the most
+        recently added entries, into the sorted arrays.
+        """
+        keys = np.concatenate([self._pending_keys[: self._num_pending], new_keys])
+        first_id = self._size - len(keys)
+        ids = np.broadcast_to(
+            np.arange(first_id, self._size, dtype=np.int64),
+            (self.num_bands, len(keys)),
+        )
+
+        keys = np.concatenate([self._sorted_keys, keys.T], axis=1)
+        ids = np.concatenate([self._sorted_ids, ids], axis=1)
+        order = np.argsort(keys, axis=1, kind="stable")
+        self._sorted_keys = np.take_along_axis(keys, order, axis=1)
+        self._sorted_ids = np.take_along_axis(ids, order, axis=1)
+        self._num_pending = 0
+
+    def _load(self, path: str):
+        if not os.path.exists(path):
+            return
+        record_size = self.num_permutations * 4
+        size = os.path.getsize(path)
+        if size % record_size:
+            # Drop a partly written last signature
+            with open(path, "r+b") as f:
+                f.truncate(size - size % record_size)
+        signatures = np.fromfile(path, dtype=np.uint32).reshape(
+            -1, self.num_permutations
+        )
+        if len(signatures):
+            self._add_signatures(signatures)
+
+    def close(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
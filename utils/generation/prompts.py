@@ -13,3 +13,18 @@ def get_qual_check_prompt(qa_string):
         {qa_string}
         """,
     )
+
+
+def get_batch_qual_check_prompt(qa_strings):
+    system_message, _ = get_qual_check_prompt("")
+    numbered_qa_strings = "\n\n".join(
+        f"[{i}]\n{qa_string}" for i, qa_string in enumerate(qa_strings, start=1)
+    )
+    return (
+        system_message,
+        f"""TODO
+        The question-answer pairs below are numbered. Give your verdict for
+        every pair, one per line, in the format "[number]: verdict".
+        {numbered_qa_strings}
+        """,
+    )
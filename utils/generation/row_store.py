@@ -0,0 +1,50 @@
+from typing import TYPE_CHECKING, Dict, Iterator, Tuple
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+class QARowStore:
+    """
+    Compact in-memory store of generated QA pairs.
+
+    Rows are kept as (question, answer) tuples keyed by row index and only
+    turned into a DataFrame when one is needed for output, avoiding the
+    reallocation that growing a DataFrame with .loc does on every row.
+    Each row can be filled exactly once.
+    """
+
+    __slots__ = ("_rows",)
+
+    def __init__(self, rows: Dict[int, Tuple[str, str]] = None):
+        self._rows = dict(rows or {})
+
+    def add(self, row: int, question: str, answer: str):
+        if row in self._rows:
+            raise ValueError(f"Row {row} has already been filled")
+        self._rows[row] = (question, answer)
+
+    def __contains__(self, row: int) -> bool:
+        return row in self._rows
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(sorted(self._rows))
+
+    def items(self) -> Iterator[Tuple[int, str, str]]:
+        """Yields (row, question, answer) in row order."""
+        for row in sorted(self._rows):
+            yield (row, *self._rows[row])
+
+    def to_dataframe(self) -> "pd.DataFrame":
+        """Builds the dataset, ordered by row."""
+        import pandas as pd
+
+        rows = sorted(self._rows)
+        return pd.DataFrame(
+            [self._rows[row] for row in rows],
+            index=rows,
+            columns=["Question", "Expected Answer"],
+        )
@@ -0,0 +1,205 @@
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+from utils.misc import count_tokens
+
+# Token length bounds for generated questions and answers
+MIN_QUESTION_TOKENS = 5
+MAX_QUESTION_TOKENS = 200
+MIN_ANSWER_TOKENS = 1
+MAX_ANSWER_TOKENS = 400
+
+# Fraction of the answer's content words that may also appear in the
+# question before the question is taken to give the answer away
+MAX_ANSWER_OVERLAP = 0.8
+
+# Answers that are never worth a quality check
+FORBIDDEN_ANSWER_PATTERNS = (
+    r"^\s*(n/?a|none|unknown|not (stated|mentioned|available))\.?\s*$",
+    r"\b(i don't know|i do not know|cannot be determined)\b",
+    r"\bPart [12]:",
+)
+
+# Words ignored when comparing questions and answers
+STOPWORDS = frozenset(
+    """a an and are as at be by for from has have in is it its of on or the
+    that this to was were what when where which who why with how did does do
+    patient patients""".split()
+)
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def content_words(text: str) -> List[str]:
+    return [w for w in WORD_PATTERN.findall(text.lower()) if w not in STOPWORDS]
+
+
+def normalise_text(text: str) -> str:
+    return " ".join(WORD_PATTERN.findall(text.lower()))
+
+
+class TokenLengthRule:
+    """Rejects questions and answers outside token length bounds."""
+
+    name = "token_length"
+
+    def __init__(
+        self,
+        model_name,
+        min_question=MIN_QUESTION_TOKENS,
+        max_question=MAX_QUESTION_TOKENS,
+        min_answer=MIN_ANSWER_TOKENS,
+        max_answer=MAX_ANSWER_TOKENS,
+    ):
+        self.model_name = model_name
+        self.min_question = min_question
+        self.max_question = max_question
+        self.min_answer = min_answer
+        self.max_answer = max_answer
+
+    def check(self, question: str, answer: str) -> bool:
+        question_tokens = count_tokens(question, self.model_name)
+        answer_tokens = count_tokens(answer, self.model_name)
+        return (
+            self.min_question <= question_tokens <= self.max_question
+            and self.min_answer <= answer_tokens <= self.max_answer
+        )
+
+
+class AnswerOverlapRule:
+    """
+    Rejects pairs whose question gives the answer away: the whole answer
+    appears in the question, or most of its content words do.
+    """
+
+    name = "answer_overlap"
+
+    def __init__(self, max_overlap=MAX_ANSWER_OVERLAP):
+        self.max_overlap = max_overlap
+
+    def check(self, question: str, answer: str) -> bool:
+        if f" {normalise_text(answer)} " in f" {normalise_text(question)} ":
+            return False
+        answer_words = set(content_words(answer))
+        if not answer_words:
+            return True
+        overlap = len(answer_words & set(content_words(question))) / len(answer_words)
+        return overlap <= self.max_overlap
+
+
+class StructureRule:
+    """
+    Rejects pairs with an empty question or answer, or whose answer matches
+    one of `forbidden_answer_patterns`. With `require_question_mark`, also
+    rejects questions that do not end in "?", which otherwise pass so that
+    imperative prompts ("List the discharge medications.") are kept.
+    """
+
+    name = "structure"
+
+    def __init__(
+        self,
+        forbidden_answer_patterns=FORBIDDEN_ANSWER_PATTERNS,
+        require_question_mark=False,
+    ):
+        self.forbidden = [
+            re.compile(pattern, re.IGNORECASE) for pattern in forbidden_answer_patterns
+        ]
+        self.require_question_mark = require_question_mark
+
+    def check(self, question: str, answer: str) -> bool:
+        if not question.strip() or not answer.strip():
+            return False
+        if self.require_question_mark and not question.rstrip().endswith("?"):
+            return False
+        return not any(pattern.search(answer) for pattern in self.forbidden)
+
+
+class NearDuplicateQuestionRule:
+    """
+    Rejects questions that are near-duplicates of an accepted question,
+    using a MinHash-LSH index that is saved to `index_path` if given.
+    """
+
+    name = "near_duplicate"
+
+    def __init__(self, index_path=None, threshold=None):
+        # Imported here so numpy is only loaded when the rule is used
+        from utils.generation.near_duplicates import (
+            SIMILARITY_THRESHOLD,
+            MinHashLSHIndex,
+        )
+
+        if threshold is None:
+            threshold = SIMILARITY_THRESHOLD
+        self.index = MinHashLSHIndex(index_path, threshold=threshold)
+
+    def check(self, question: str, answer: str) -> bool:
+        return self.index.query(question) is None
+
+    def add(self, question: str, answer: str) -> bool:
+        return self.index.add_if_new(question)
+
+    def close(self):
+        self.index.close()
+
+
+class ValidationPipeline:
+    """
+    Cheap local checks that QA pairs must pass before the paid quality
+    check.
+
+    Rules run in order and a pair is rejected by the first rule it fails.
+    Rejections are counted per rule, so each count is the number of
+    quality check calls that rule saved. Rules that need to know about
+    accepted pairs (such as duplicate detection) are told about them with
+    `add_accepted`.
+    """
+
+    def __init__(self, rules: Iterable):
+        self.rules = list(rules)
+        self.checked = 0
+        self.rejections = Counter()
+
+    @classmethod
+    def default(cls, model_name, index_path=None) -> "ValidationPipeline":
+        return cls(
+            [
+                StructureRule(),
+                TokenLengthRule(model_name),
+                AnswerOverlapRule(),
+                NearDuplicateQuestionRule(index_path),
+            ]
+        )
+
+    def rejecting_rule(self, question: str, answer: str) -> Optional[str]:
+        """Returns the name of the first rule the pair fails, or None."""
+        self.checked += 1
+        for rule in self.rules:
+            if not rule.check(question, answer):
+                self.rejections[rule.name] += 1
+                return rule.name
+        return None
+
+    def add_accepted(self, question: str, answer: str) -> bool:
+        """
+        Records an accepted pair. Returns False if it duplicates a pair
+        accepted earlier, e.g. by another candidate from the same request.
+        """
+        new = True
+        for rule in self.rules:
+            if hasattr(rule, "add"):
+                new = rule.add(question, answer) and new
+        return new
+
+    def close(self):
+        for rule in self.rules:
+            if hasattr(rule, "close"):
+                rule.close()
+
+    def stats(self) -> Dict[str, int]:
+        stats = {"checked": self.checked, "passed": self.checked}
+        for rule in self.rules:
+            stats[f"rejected_{rule.name}"] = self.rejections[rule.name]
+            stats["passed"] -= self.rejections[rule.name]
+        return stats
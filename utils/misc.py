@@ -1,7 +1,9 @@
+import json
 import sys
 import os
 from datetime import datetime
-import tiktoken
+from functools import lru_cache
+from typing import Callable, Dict, List, Pattern, Sequence
 import random
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
@@ -11,6 +13,9 @@ sys.path.insert(0, parent_dir)
 NUMBER_OF_QA_PAIRS = 1000
 MODEL_NAME = "gpt-4"
 
+# Default number of threads used for batched token counting
+TOKENIZER_THREADS = os.cpu_count() or 1
+
 
 def save_dataset(dataset, directory: str):
     date = datetime.now()
@@ -19,33 +24,184 @@ def save_dataset(dataset, directory: str):
     dataset.to_csv(f"{output_path}.csv")
 
 
-def count_tokens(text, model):
+@lru_cache(maxsize=None)
+def get_encoder(model):
+    """Returns the tiktoken encoder for a model, loading it only once."""
+    import tiktoken
+
     if "gpt-4o" in model:
-        encoder = tiktoken.get_encoding("o200k_base")  # GPT-4o
-    else:
-        encoder = tiktoken.encoding_for_model(model)  # GPT-3
-    return len(encoder.encode(text))
+        return tiktoken.get_encoding("o200k_base")  # GPT-4o
+    try:
+        return tiktoken.encoding_for_model(model)  # GPT-3
+    except KeyError:
+        # Unknown (e.g. custom Azure deployment) names
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text, model):
+    return len(get_encoder(model).encode(text))
+
+
+def count_tokens_batch(
+    strings: Sequence, model=MODEL_NAME, num_threads: int = TOKENIZER_THREADS
+) -> List[int]:
+    """
+    Counts the tokens of many strings at once.
+
+    Strings are encoded with encode_ordinary_batch, which spreads the work
+    over `num_threads` threads. Tuples are counted as their string form, as
+    in calculate_average_tokens.
+    """
+    strings = [str(s) if type(s) == tuple else s for s in strings]
+    encoded = get_encoder(model).encode_ordinary_batch(strings, num_threads=num_threads)
+    return [len(tokens) for tokens in encoded]
+
+
+def pack_by_token_budget(
+    items: Sequence,
+    item_text: Callable,
+    base_tokens: int,
+    model,
+    token_budget: int,
+    max_group_size: int,
+) -> List[List[int]]:
+    """
+    Groups items into numbered prompts that fit in one request.
+
+    Groups are filled greedily in order, using count_tokens to keep each
+    prompt, `base_tokens` without any items, within `token_budget`.
+    item_text(number, item) is the text an item adds as the `number`th
+    (1-based) item of its group. An item too long for the budget on its
+    own still gets a group of its own.
+
+    Returns a list of groups of indices into `items`.
+    """
+    groups = []
+    group = []
+    group_tokens = base_tokens
+    for index, item in enumerate(items):
+        item_tokens = count_tokens(item_text(len(group) + 1, item), model)
+        if group and (
+            group_tokens + item_tokens > token_budget or len(group) >= max_group_size
+        ):
+            groups.append(group)
+            group = []
+            group_tokens = base_tokens
+        group.append(index)
+        group_tokens += item_tokens
+
+    if group:
+        groups.append(group)
+    return groups
+
+
+def parse_numbered_lines(
+    response: str, group_size: int, pattern: Pattern
+) -> Dict[int, str]:
+    """
+    Parses the numbered lines of a response to a group of items into
+    {position: value}, where `pattern` captures a line's 1-based number and
+    its value.
+
+    Positions are 0-based. Lines that do not match, numbers outside the
+    group and repeated numbers are ignored, so the result only contains the
+    values that could be read unambiguously.
+    """
+    values = {}
+    repeated = set()
+    for match in pattern.finditer(response or ""):
+        position = int(match.group(1)) - 1
+        if not 0 <= position < group_size:
+            continue
+        if position in values:
+            repeated.add(position)
+        values[position] = match.group(2)
+
+    for position in repeated:
+        del values[position]
+    return values
+
+
+def load_jsonl_log(path: str, entry_name: str = "entry") -> List[dict]:
+    """
+    Reads the entries of an append-only JSONL file.
+
+    A last line that was only partly written, because it has no trailing
+    newline or does not decode, is truncated away so that later appends
+    start on a clean line. An undecodable line anywhere else means the
+    file is corrupt, and raises ValueError.
+    """
+    entries = []
+    if not os.path.exists(path):
+        return entries
+
+    valid_length = 0
+    bad_line = None
+    with open(path, "rb") as f:
+        for number, line in enumerate(f, 1):
+            if bad_line is not None:
+                raise ValueError(f"Corrupt {entry_name} on line {bad_line} of {path}")
+            if not line.endswith(b"\n"):
+                break
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                bad_line = number
+                continue
+            valid_length += len(line)
+
+    if valid_length < os.path.getsize(path):
+        print(f"Truncating incomplete {entry_name} in {path}")
+        with open(path, "r+b") as f:
+            f.truncate(valid_length)
+    return entries
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    # Linear interpolation between closest ranks, as numpy.percentile does
+    position = (len(sorted_values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    fraction = position - lower
+    return (
+        sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * fraction
+    )
+
+
+def token_stats(
+    strings: Sequence,
+    model_name=MODEL_NAME,
+    percentiles: Sequence[float] = (50, 90, 95, 99),
+    num_threads: int = TOKENIZER_THREADS,
+) -> Dict[str, float]:
+    """
+    Computes token count statistics for a collection of strings in one pass.
+
+    Returns a dictionary with the number of strings ("count"), the total,
+    mean and maximum token counts, and a "p<n>" entry for each requested
+    percentile.
+    """
+    counts = sorted(count_tokens_batch(strings, model_name, num_threads))
+    if not counts:
+        raise ValueError("Cannot compute token statistics of no strings")
+
+    stats = {
+        "count": len(counts),
+        "total": sum(counts),
+        "mean": sum(counts) / len(counts),
+        "max": counts[-1],
+    }
+    for p in percentiles:
+        stats[f"p{p:g}"] = percentile(counts, p)
+    return stats
 
 
 def calculate_average_tokens(strings, model_name=MODEL_NAME):
-    total_tokens = 0
-    for string in strings:
-        if type(string) == tuple:
-            string = str(string)
-        total_tokens += count_tokens(string, model_name)
-    average_tokens = total_tokens / len(strings)
-    return average_tokens
+    return token_stats(strings, model_name, percentiles=())["mean"]
 
 
 def calculate_max_tokens(strings, model_name=MODEL_NAME):
-    max_tokens = 0
-    for string in strings:
-        if type(string) == tuple:
-            string = str(string)
-        token_count = count_tokens(string, model_name)
-        if token_count > max_tokens:
-            max_tokens = token_count
-    return max_tokens
+    return max(count_tokens_batch(strings, model_name), default=0)
 
 
 def select_capability_type(factual_proportion: int, reasoning_proportion: int) -> str:
@@ -0,0 +1,322 @@
+import asyncio
+import random
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, Optional
+
+# Retry settings for throttled and failed requests
+MAX_RETRIES = 10
+BASE_RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+# AIMD concurrency settings: start at INITIAL_CONCURRENCY, add about one
+# slot per round of successful requests and halve on throttling
+INITIAL_CONCURRENCY = 8
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 64
+DECREASE_FACTOR = 0.5
+
+# Minimum time between two multiplicative decreases, so that a burst of
+# 429s from requests that were already in flight only counts once
+DECREASE_COOLDOWN = 1.0
+
+# Stop growing concurrency when the deployment reports less than this
+# fraction of its request or token quota left
+LOW_REMAINING_FRACTION = 0.1
+
+# Poll interval for async callers waiting for a free slot
+ASYNC_POLL_INTERVAL = 0.01
+
+
+@lru_cache(maxsize=None)
+def retryable_errors() -> tuple:
+    """
+    Errors that are retried with backoff. Only RateLimitError counts as
+    throttling for the concurrency limit. openai is imported on first use,
+    by which time a client has already loaded it.
+    """
+    from openai import (
+        APIConnectionError,
+        APITimeoutError,
+        InternalServerError,
+        RateLimitError,
+    )
+
+    return (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    from openai import RateLimitError
+
+    return isinstance(error, RateLimitError)
+
+
+def _header_float(headers, name) -> Optional[float]:
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after_seconds(headers) -> Optional[float]:
+    """Reads the server-requested delay from retry-after(-ms) headers."""
+    if headers is None:
+        return None
+    retry_after_ms = _header_float(headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    return _header_float(headers, "retry-after")
+
+
+class AdaptiveRateLimiter:
+    """
+    Shared rate control for one deployment.
+
+    Limits the number of requests in flight and adapts that limit AIMD
+    style: it grows by roughly one slot per round of successful requests
+    and is cut by DECREASE_FACTOR when the deployment returns a 429. A
+    Retry-After header pauses every caller of the deployment, not just the
+    one that was throttled, and retries without one use exponential
+    backoff with full jitter. x-ratelimit-remaining-* headers stop the
+    limit from growing when the quota is nearly used up.
+
+    The same limiter can be used from threads (`call`) and from asyncio
+    tasks (`call_async`).
+    """
+
+    def __init__(
+        self,
+        name: str = "default",
+        initial_concurrency: float = INITIAL_CONCURRENCY,
+        min_concurrency: float = MIN_CONCURRENCY,
+        max_concurrency: float = MAX_CONCURRENCY,
+        max_retries: int = MAX_RETRIES,
+    ):
+        self.name = name
+        self.limit = float(initial_concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._quota_low = False
+
+        # Smallest reported fraction of the request/token quota left, None
+        # until the deployment has sent x-ratelimit headers
+        self.remaining_fraction = None
+        self._condition = threading.Condition()
+
+    # Slot management
+
+    def _try_acquire(self) -> float:
+        """
+        Takes a slot if one is free. Returns 0 on success, otherwise the
+        number of seconds worth waiting before trying again.
+        """
+        with self._condition:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                return pause
+            if self.in_flight >= max(int(self.limit), self.min_concurrency):
+                return ASYNC_POLL_INTERVAL
+            self.in_flight += 1
+            self.requests += 1
+            return 0
+
+    def _release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def acquire(self):
+        while True:
+            wait = self._try_acquire()
+            if not wait:
+                return
+            with self._condition:
+                self._condition.wait(timeout=wait)
+
+    async def acquire_async(self):
+        while True:
+            wait = self._try_acquire()
+            if not wait:
+                return
+            await asyncio.sleep(min(wait, ASYNC_POLL_INTERVAL * 10))
+
+    # Feedback from responses
+
+    def on_success(self, headers=None):
+        with self._condition:
+            if headers is not None:
+                self._update_quota(headers)
+            if not self._quota_low:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def on_throttle(self, headers=None) -> Optional[float]:
+        """
+        Records a 429 and returns the delay requested by the server, if any.
+        """
+        retry_after = retry_after_seconds(headers)
+        now = time.monotonic()
+        with self._condition:
+            self.throttled += 1
+            if now - self._last_decrease >= DECREASE_COOLDOWN:
+                self.limit = max(self.min_concurrency, self.limit * DECREASE_FACTOR)
+                self._last_decrease = now
+            if retry_after is not None:
+                self._paused_until = max(self._paused_until, now + retry_after)
+        return retry_after
+
+    def _update_quota(self, headers):
+        fractions = []
+        for kind in ("requests", "tokens"):
+            remaining = _header_float(headers, f"x-ratelimit-remaining-{kind}")
+            limit = _header_float(headers, f"x-ratelimit-limit-{kind}")
+            if remaining is None:
+                continue
+            if remaining <= 0:
+                fractions.append(0.0)
+            elif limit:
+                fractions.append(remaining / limit)
+
+        if fractions:
+            self.remaining_fraction = min(fractions)
+        self._quota_low = bool(fractions) and min(fractions) < LOW_REMAINING_FRACTION
+
+    def backoff_delay(self, attempt: int, retry_after: Optional[float]) -> float:
+        if retry_after is not None:
+            # Small jitter so that paused callers do not all retry at once
+            return retry_after + random.uniform(0, BASE_RETRY_DELAY)
+        return random.uniform(0, min(MAX_RETRY_DELAY, BASE_RETRY_DELAY * 2**attempt))
+
+    def paused_for(self) -> float:
+        """Seconds until the deployment's Retry-After pause ends."""
+        with self._condition:
+            return max(0.0, self._paused_until - time.monotonic())
+
+    def load(self) -> float:
+        """Fraction of the current concurrency limit that is in use."""
+        with self._condition:
+            return self.in_flight / self.limit
+
+    # Request execution
+
+    def attempt(self, request_function, **kwargs):
+        """
+        Makes a single attempt at request_function(**kwargs) under the
+        limiter, recording the outcome. Errors are re-raised.
+        """
+        self.acquire()
+        try:
+            result = request_function(**kwargs)
+        except Exception as e:
+            if is_rate_limit_error(e):
+                self.on_throttle(e.response.headers)
+            raise
+        else:
+            self.on_success(getattr(result, "headers", None))
+            return result
+        finally:
+            self._release()
+
+    async def attempt_async(self, request_function, **kwargs):
+        """Asynchronous version of attempt for coroutine request functions."""
+        await self.acquire_async()
+        try:
+            result = await request_function(**kwargs)
+        except Exception as e:
+            if is_rate_limit_error(e):
+                self.on_throttle(e.response.headers)
+            raise
+        else:
+            self.on_success(getattr(result, "headers", None))
+            return result
+        finally:
+            self._release()
+
+    def retry_delay(self, attempt: int, error: Exception) -> float:
+        """
+        Returns how long to wait after a failed attempt, and logs it.
+        """
+        with self._condition:
+            self.retries += 1
+
+        if is_rate_limit_error(error):
+            delay = self.backoff_delay(
+                attempt, retry_after_seconds(error.response.headers)
+            )
+            print(
+                f"Rate limit exceeded on {self.name}. "
+                f"Attempt {attempt + 1} of {self.max_retries}, "
+                f"retrying in {delay:.1f}s."
+            )
+        else:
+            delay = self.backoff_delay(attempt, None)
+            print(f"Request failed on {self.name} ({error}), retrying in {delay:.1f}s.")
+        return delay
+
+    def call(self, request_function, **kwargs):
+        """
+        Calls request_function(**kwargs) under the limiter, retrying
+        throttled and transient failures.
+        """
+        for attempt in range(0, self.max_retries):
+            try:
+                return self.attempt(request_function, **kwargs)
+            except retryable_errors() as e:
+                time.sleep(self.retry_delay(attempt, e))
+
+        raise RuntimeError("Maximum retries exceeded.")
+
+    async def call_async(self, request_function, **kwargs):
+        """Asynchronous version of call for coroutine request functions."""
+        for attempt in range(0, self.max_retries):
+            try:
+                return await self.attempt_async(request_function, **kwargs)
+            except retryable_errors() as e:
+                await asyncio.sleep(self.retry_delay(attempt, e))
+
+        raise RuntimeError("Maximum retries exceeded.")
+
+    def stats(self) -> Dict[str, float]:
+        with self._condition:
+            return {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "retries": self.retries,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(client, model_name) -> AdaptiveRateLimiter:
+    """
+    Returns the process-wide limiter for a deployment, identified by the
+    client's endpoint and the deployment (model) name.
+    """
+    key = f"{client.base_url}{model_name}"
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = AdaptiveRateLimiter(key)
+            _limiters[key] = limiter
+    return limiter
+
+
+def rate_limiter_stats() -> Dict[str, Dict[str, float]]:
+    """Returns the stats of every deployment's limiter, keyed by deployment."""
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {key: limiter.stats() for key, limiter in limiters.items()}
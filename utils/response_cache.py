@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# Location of the on-disk cache, can be overridden with LLM_CACHE_PATH
+DEFAULT_CACHE_PATH = "data/cache/llm_responses.sqlite"
+
+# Eviction limits: total size of cached responses and maximum entry age
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+
+# Number of writes between eviction passes
+EVICTION_INTERVAL = 1000
+
+
+class ResponseCache:
+    """
+    Persistent, content-addressed cache of chat completion responses.
+
+    Entries are keyed by a SHA-256 hash of the full request (model, messages
+    and sampling parameters) and the base URL it is sent to, and stored in
+    SQLite, so identical requests made by later runs are answered from
+    disk. Requests with temperature > 0 are not deterministic and bypass
+    the cache unless `cache_sampled` is set.
+
+    Least recently used entries are evicted once the cached responses exceed
+    `max_bytes`, and entries older than `max_age_seconds` are dropped.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        max_age_seconds: float = DEFAULT_MAX_AGE_SECONDS,
+        cache_sampled: bool = False,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.cache_sampled = cache_sampled
+
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self._writes = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # One connection shared by all threads, serialised with a lock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )""")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed_at "
+            "ON responses (accessed_at)"
+        )
+        self._connection.commit()
+
+    def is_cacheable(self, request: Dict[str, Any]) -> bool:
+        return self.cache_sampled or request.get("temperature", 1) == 0
+
+    @staticmethod
+    def make_key(request: Dict[str, Any], base_url: Optional[str] = None) -> str:
+        """
+        Hashes the request together with the `base_url` serving it, so
+        endpoints that deploy the same model name do not share entries.
+        """
+        serialised = json.dumps(
+            {"base_url": base_url, "request": request},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(serialised.encode("utf-8")).hexdigest()
+
+    def lookup(
+        self, request: Dict[str, Any], base_url: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        Returns the cached response for a request to `base_url`, or None on
+        a miss or if the request is not cacheable.
+        """
+        if not self.is_cacheable(request):
+            with self._lock:
+                self.bypassed += 1
+            return None
+
+        key = self.make_key(request, base_url)
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] <= self.max_age_seconds:
+                self._connection.execute(
+                    "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+                )
+                self._connection.commit()
+                self.hits += 1
+                return row[0]
+
+            self.misses += 1
+        return None
+
+    def store(
+        self, request: Dict[str, Any], response: str, base_url: Optional[str] = None
+    ):
+        """Stores the response to a cacheable request to `base_url`."""
+        if response is None or not self.is_cacheable(request):
+            return
+
+        key = self.make_key(request, base_url)
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, response, len(response.encode("utf-8")), now, now),
+            )
+            self._connection.commit()
+            self._writes += 1
+            if self._writes % EVICTION_INTERVAL == 0:
+                self._evict()
+
+    def evict(self):
+        """Drops expired entries, then LRU entries until under max_bytes."""
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        self._connection.execute(
+            "DELETE FROM responses WHERE created_at < ?",
+            (time.time() - self.max_age_seconds,),
+        )
+        total_bytes = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+        if total_bytes > self.max_bytes:
+            # Walk entries from least to most recently used and delete the
+            # oldest ones until the cache fits again
+            excess = total_bytes - self.max_bytes
+            to_delete = []
+            for key, size in self._connection.execute(
+                "SELECT key, size FROM responses ORDER BY accessed_at"
+            ):
+                if excess <= 0:
+                    break
+                to_delete.append((key,))
+                excess -= size
+            self._connection.executemany(
+                "DELETE FROM responses WHERE key = ?", to_delete
+            )
+        self._connection.commit()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries, total_bytes = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "entries": entries,
+            "bytes": total_bytes,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """
+    Returns the process-wide response cache, or None if caching is disabled
+    with LLM_CACHE_DISABLED=1.
+    """
+    global _cache
+    if os.getenv("LLM_CACHE_DISABLED") == "1":
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(os.getenv("LLM_CACHE_PATH", DEFAULT_CACHE_PATH))
+    return _cache
+
+
+def print_response_cache_stats():
+    """
+    Evicts expired and least recently used entries from the process-wide
+    response cache, if enabled, and prints its hit and miss counts.
+    """
+    cache = get_response_cache()
+    if cache is not None:
+        cache.evict()
+        print(f"Response cache: {cache.stats()}")
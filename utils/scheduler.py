@@ -0,0 +1,166 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+from utils.misc import count_tokens
+
+# Fraction of the quota to schedule up to, leaving headroom for estimation
+# error and other users of the deployment
+QUOTA_HEADROOM = 0.95
+
+# Azure enforces per-minute quotas over short windows, so the buckets only
+# allow bursts of this many seconds worth of quota
+BURST_SECONDS = 10
+
+# Extra tokens the API adds for each chat message
+TOKENS_PER_MESSAGE = 4
+
+
+def estimate_request_tokens(request: Dict[str, Any]) -> int:
+    """
+    Estimates the quota tokens a chat completion request uses: its prompt
+    tokens, counted with count_tokens, plus its max_tokens.
+    """
+    prompt_tokens = sum(
+        count_tokens(message["content"], request["model"]) + TOKENS_PER_MESSAGE
+        for message in request["messages"]
+    )
+    return prompt_tokens + request.get("max_tokens", 0) * request.get("n", 1)
+
+
+class _TokenBucket:
+    """Token bucket refilled continuously at `per_minute` per minute."""
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute * QUOTA_HEADROOM / 60
+        self.capacity = max(1.0, self.rate * BURST_SECONDS)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        """
+        Takes `amount` from the bucket, allowing it to go negative, and
+        returns how long the caller must wait until the reservation is
+        covered. Amounts larger than the capacity are charged in full, so
+        they wait for the whole deficit rather than overrunning the quota.
+        """
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+
+class AdmissionScheduler:
+    """
+    Proactive tokens-per-minute and requests-per-minute admission control
+    for one deployment.
+
+    Each request reserves its estimated token cost and one request from a
+    pair of token buckets sized just under the deployment's quota, and waits
+    until both reservations are covered. Reservations are made in arrival
+    order, so requests are admitted first come, first served, and the
+    deployment is kept close to, but under, its quota without 429s.
+    """
+
+    def __init__(
+        self,
+        tokens_per_minute: Optional[float] = None,
+        requests_per_minute: Optional[float] = None,
+    ):
+        self._tokens = _TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._requests = (
+            _TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self._lock = threading.Lock()
+
+        self.queue_depth = 0
+        self.admitted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _reserve(self, request: Dict[str, Any]) -> float:
+        # Only count tokens when a token quota is being enforced
+        tokens = estimate_request_tokens(request) if self._tokens is not None else 0
+
+        now = time.monotonic()
+        with self._lock:
+            wait = 0.0
+            if self._tokens is not None:
+                wait = max(wait, self._tokens.reserve(tokens, now))
+            if self._requests is not None:
+                wait = max(wait, self._requests.reserve(1, now))
+
+            self.admitted += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            if wait:
+                self.queue_depth += 1
+        return wait
+
+    def _leave_queue(self):
+        with self._lock:
+            self.queue_depth -= 1
+
+    def admit(self, request: Dict[str, Any]):
+        """Blocks until a chat completion request may be sent."""
+        wait = self._reserve(request)
+        if wait:
+            time.sleep(wait)
+            self._leave_queue()
+
+    async def admit_async(self, request: Dict[str, Any]):
+        """Asynchronous version of admit."""
+        wait = self._reserve(request)
+        if wait:
+            await asyncio.sleep(wait)
+            self._leave_queue()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "queue_depth": self.queue_depth,
+                "admitted": self.admitted,
+                "total_wait": self.total_wait,
+                "mean_wait": self.total_wait / self.admitted if self.admitted else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+
+def _env_quota(name: str) -> Optional[float]:
+    value = os.getenv(name)
+    return float(value) if value else None
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(
+    client, model_name, tokens_per_minute=None, requests_per_minute=None
+) -> AdmissionScheduler:
+    """
+    Returns the process-wide admission scheduler for a deployment.
+
+    Quotas not given explicitly are read from LLM_TOKENS_PER_MINUTE and
+    LLM_REQUESTS_PER_MINUTE. A quota that is not set is not enforced.
+    """
+    key = f"{client.base_url}{model_name}"
+    with _schedulers_lock:
+        scheduler = _schedulers.get(key)
+        if scheduler is None:
+            scheduler = AdmissionScheduler(
+                tokens_per_minute=tokens_per_minute
+                or _env_quota("LLM_TOKENS_PER_MINUTE"),
+                requests_per_minute=requests_per_minute
+                or _env_quota("LLM_REQUESTS_PER_MINUTE"),
+            )
+            _schedulers[key] = scheduler
+    return scheduler
+
+
+def scheduler_stats() -> Dict[str, Dict[str, float]]:
+    """Returns the stats of every deployment's scheduler, keyed by deployment."""
+    with _schedulers_lock:
+        schedulers = dict(_schedulers)
+    return {key: scheduler.stats() for key, scheduler in schedulers.items()}
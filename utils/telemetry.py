@@ -0,0 +1,286 @@
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Optional
+
+# Price in USD per million (prompt, completion) tokens, by model name
+# prefix. The longest matching prefix is used.
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4": (30.00, 60.00),
+    "gpt-35-turbo": (0.50, 1.50),
+}
+
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Prefix of the exported Prometheus metric names
+METRIC_PREFIX = "stacity"
+
+
+def model_price(model_name: str) -> Optional[tuple]:
+    matches = [prefix for prefix in MODEL_PRICES if model_name.startswith(prefix)]
+    if not matches:
+        return None
+    return MODEL_PRICES[max(matches, key=len)]
+
+
+class _CallStats:
+    __slots__ = (
+        "calls",
+        "failures",
+        "cache_hits",
+        "prompt_tokens",
+        "completion_tokens",
+        "retries",
+        "throttled",
+        "latency_sum",
+        "latency_buckets",
+    )
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.cache_hits = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.retries = 0
+        self.throttled = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+
+
+class Telemetry:
+    """
+    Per-call telemetry for the chat completion requests of a run.
+
+    Every request records its latency, token usage, retries and 429s under
+    a label (generation, quality_check, annotation) and model, and the
+    generation loop records what happened to each candidate. Calls are
+    appended to `events_path` as JSONL events if given, and the totals can
+    be exported in the Prometheus text format and summarised as accepted
+    pairs per dollar and per minute.
+    """
+
+    def __init__(self, events_path: Optional[str] = None):
+        self.started = time.monotonic()
+        self.calls: Dict[tuple, _CallStats] = defaultdict(_CallStats)
+        self.outcomes = Counter()
+        self._lock = threading.Lock()
+
+        self.events_path = events_path
+        self._file = None
+        if events_path is not None:
+            directory = os.path.dirname(events_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(events_path, "a", encoding="utf-8")
+
+    def _write_event(self, event: dict):
+        if self._file is not None:
+            self._file.write(json.dumps(event) + "\n")
+            self._file.flush()
+
+    def record_call(
+        self,
+        label: Optional[str],
+        model_name: str,
+        latency: float,
+        usage=None,
+        retries: int = 0,
+        throttled: int = 0,
+        cached: bool = False,
+        failed: bool = False,
+        deployment: Optional[str] = None,
+    ):
+        """
+        Records one chat completion call. `usage` is the response's usage
+        object, or None when it is unknown (cache hits and streams).
+        """
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+        label = label or "other"
+
+        with self._lock:
+            stats = self.calls[(label, model_name)]
+            stats.calls += 1
+            stats.failures += failed
+            stats.cache_hits += cached
+            stats.prompt_tokens += prompt_tokens or 0
+            stats.completion_tokens += completion_tokens or 0
+            stats.retries += retries
+            stats.throttled += throttled
+            stats.latency_sum += latency
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    stats.latency_buckets[i] += 1
+
+            self._write_event(
+                {
+                    "event": "call",
+                    "time": time.time(),
+                    "label": label,
+                    "model": model_name,
+                    "deployment": deployment,
+                    "latency": round(latency, 4),
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "retries": retries,
+                    "throttled": throttled,
+                    "cached": cached,
+                    "failed": failed,
+                }
+            )
+
+    def record_outcome(self, outcome: str, count: int = 1):
+        """
+        Records `count` candidates ending in `outcome`, e.g. "accepted" or
+        "rejected_quality_check".
+        """
+        if count <= 0:
+            return
+        with self._lock:
+            self.outcomes[outcome] += count
+            self._write_event(
+                {
+                    "event": "outcome",
+                    "time": time.time(),
+                    "outcome": outcome,
+                    "count": count,
+                }
+            )
+
+    def cost(self) -> float:
+        """Estimated cost in USD of the tokens used so far."""
+        total = 0.0
+        with self._lock:
+            for (_, model_name), stats in self.calls.items():
+                price = model_price(model_name)
+                if price is not None:
+                    total += (
+                        stats.prompt_tokens * price[0]
+                        + stats.completion_tokens * price[1]
+                    ) / 1e6
+        return total
+
+    def summary(self) -> dict:
+        minutes = (time.monotonic() - self.started) / 60
+        cost = self.cost()
+        with self._lock:
+            stats = list(self.calls.values())
+            accepted = self.outcomes["accepted"]
+        return {
+            "calls": sum(s.calls for s in stats),
+            "failures": sum(s.failures for s in stats),
+            "cache_hits": sum(s.cache_hits for s in stats),
+            "retries": sum(s.retries for s in stats),
+            "throttled": sum(s.throttled for s in stats),
+            "prompt_tokens": sum(s.prompt_tokens for s in stats),
+            "completion_tokens": sum(s.completion_tokens for s in stats),
+            "cost_usd": round(cost, 4),
+            "minutes": round(minutes, 2),
+            "accepted": accepted,
+            "accepted_per_dollar": round(accepted / cost, 2) if cost else None,
+            "accepted_per_minute": round(accepted / minutes, 2) if minutes else None,
+        }
+
+    def prometheus_text(self) -> str:
+        """Renders the totals in the Prometheus text exposition format."""
+        lines = []
+
+        def metric(name, kind, description, samples):
+            name = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                rendered = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{suffix}{{{rendered}}} {value}")
+
+        with self._lock:
+            calls = sorted(self.calls.items())
+            outcomes = sorted(self.outcomes.items())
+
+        def counter(name, description, attribute):
+            metric(
+                name,
+                "counter",
+                description,
+                [
+                    ("", {"label": label, "model": model}, getattr(stats, attribute))
+                    for (label, model), stats in calls
+                ],
+            )
+
+        counter("llm_calls_total", "Chat completion calls.", "calls")
+        counter("llm_failures_total", "Calls that failed after retries.", "failures")
+        counter("llm_cache_hits_total", "Calls answered from the cache.", "cache_hits")
+        counter("llm_retries_total", "Retried attempts.", "retries")
+        counter("llm_throttled_total", "Attempts throttled with a 429.", "throttled")
+        counter("llm_prompt_tokens_total", "Prompt tokens used.", "prompt_tokens")
+        counter(
+            "llm_completion_tokens_total",
+            "Completion tokens used.",
+            "completion_tokens",
+        )
+
+        samples = []
+        for (label, model), stats in calls:
+            labels = {"label": label, "model": model}
+            for bound, count in zip(LATENCY_BUCKETS, stats.latency_buckets):
+                samples.append(("_bucket", {**labels, "le": bound}, count))
+            samples.append(("_bucket", {**labels, "le": "+Inf"}, stats.calls))
+            samples.append(("_sum", labels, round(stats.latency_sum, 4)))
+            samples.append(("_count", labels, stats.calls))
+        metric(
+            "llm_call_latency_seconds",
+            "histogram",
+            "Chat completion call latency, including retries.",
+            samples,
+        )
+
+        metric(
+            "candidates_total",
+            "counter",
+            "Generated candidates by outcome.",
+            [("", {"outcome": outcome}, count) for outcome, count in outcomes],
+        )
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """Writes prometheus_text() to `path`, replacing it atomically."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(temporary_path, path)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_telemetry = Telemetry()
+_telemetry_lock = threading.Lock()
+
+
+def get_telemetry() -> Telemetry:
+    """Returns the process-wide telemetry."""
+    return _telemetry
+
+
+def configure_telemetry(events_path: Optional[str] = None) -> Telemetry:
+    """
+    Replaces the process-wide telemetry with a new one writing events to
+    `events_path`, and returns it.
+    """
+    global _telemetry
+    with _telemetry_lock:
+        _telemetry.close()
+        _telemetry = Telemetry(events_path)
+    return _telemetry